@@ -0,0 +1,625 @@
+"""
+MsM measures
+Native NumPy port of matlab_msm/msm_lin.m, msm_log.m and msm_log_inc.m
+
+Besides the scalars of the matlab code, p, q, r and s can be N arrays of
+per rank probabilities or K x N arrays of per query and rank ones.
+"""
+import itertools
+import numpy as np
+from plan_cache import PlanCache, _normalize
+
+VARIANTS = ('lin', 'log', 'log_inc')
+
+
+def _check_params(p, q, r, s):
+    """
+    same constraints as the validateattributes calls of the matlab code,
+    on every value of per rank (query) parameters
+    """
+    if not np.all((0 < np.asarray(p)) & (np.asarray(p) <= 1)):
+        raise ValueError('p must be in (0, 1], got %r' % (p,))
+    if not np.all((0 <= np.asarray(q)) & (np.asarray(q) <= 1)):
+        raise ValueError('q must be in [0, 1], got %r' % (q,))
+    if not np.all((0 < np.asarray(r)) & (np.asarray(r) <= 1)):
+        raise ValueError('r must be in (0, 1], got %r' % (r,))
+    if not np.all((0 < np.asarray(s)) & (np.asarray(s) <= 1)):
+        raise ValueError('s must be in (0, 1], got %r' % (s,))
+
+
+def _per_query(N, K, p, q, r, s):
+    """whether some of p, q, r, s are K x N per query arrays; check the shapes"""
+    per_query = False
+    for name, x in zip('pqrs', (p, q, r, s)):
+        shape = np.shape(x)
+        if shape == (K, N) and K > 0:
+            per_query = True
+        elif shape not in ((), (N,)):
+            raise ValueError('%s must be a scalar, a N=%d (per rank) or a K x N=%d x %d '
+                             '(per query and rank) array, got shape %r' % (name, N, K, N, shape))
+    return per_query
+
+
+def _ranks(x, N):
+    """(N,) values of a scalar or per rank parameter"""
+    return np.array(np.broadcast_to(np.asarray(x, dtype=float), (N,)))
+
+
+def _check_run(run):
+    run = np.asarray(run, dtype=float)
+    if run.ndim != 2 or run.size == 0:
+        raise ValueError('run must be a non empty N x K matrix')
+    if (run < 0).any() or (run != np.floor(run)).any():
+        raise ValueError('run must contain natural numbers only')
+    if run.shape[0] < 2:
+        raise ValueError('run must have at least 2 documents per query')
+    return run
+
+
+def _stochastic(P):
+    """make every row of P sum up to 1 again (bsxfun(@rdivide, P, sum(P, 2)))"""
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return P / P.sum(axis=1, keepdims=True)
+
+
+def transition_matrix(N, p, q, r, s):
+    """
+    return the (N+2) x (N+2) transition matrix of the MsM random walk
+
+    The first N states are the documents of a result list, state N (F) is
+    the end of the search session and state N+1 (Q) is the jump to the next
+    query. The first and last documents have re-scaled probabilities since
+    there is no backward (forward) transition for them.
+    p, q, r and s are scalars or per rank arrays.
+    """
+    p, q, r, s = (_ranks(x, N) for x in (p, q, r, s))
+    p1, s1, r1 = p[0] / (p[0] + s[0] + r[0]), s[0] / (p[0] + s[0] + r[0]), r[0] / (p[0] + s[0] + r[0])
+    qN, sN, rN = q[-1] / (q[-1] + s[-1] + r[-1]), s[-1] / (q[-1] + s[-1] + r[-1]), \
+        r[-1] / (q[-1] + s[-1] + r[-1])
+
+    F, Q = N, N + 1
+    P = np.zeros((N + 2, N + 2))
+    idx = np.arange(N - 1)
+    P[idx, idx + 1] = [p1] + list(p[1:N - 1])
+    P[idx + 1, idx] = list(q[1:N - 1]) + [qN]
+    P[:N, F] = [s1] + list(s[1:N - 1]) + [sN]
+    P[:N, Q] = [r1] + list(r[1:N - 1]) + [rN]
+    P[F, F] = 1
+    P[Q, Q] = 1
+    return P
+
+
+def _check_shape(N, K):
+    if N < 2:
+        raise ValueError('N must be at least 2, got %r' % N)
+    if K < 1:
+        raise ValueError('K must be at least 1, got %r' % K)
+
+
+def _query_probs(hF1, hFK1, K):
+    """
+    pj, the probability of reaching query j, from hF(1) and hFK(1); hF1 is
+    a (K,) array of every query with per query parameters
+    """
+    # probability to go from document 1 of the first query to F of query j
+    hj = np.empty(K)
+    if np.ndim(hF1) == 0:
+        hj[:K - 1] = (1 - hF1) ** np.arange(K - 1) * hF1
+        hj[K - 1] = (1 - hF1) ** (K - 1) * hFK1
+    else:
+        # probability of not ending in any query before j
+        stay = np.cumprod(np.concatenate(([1.0], 1 - hF1[:K - 1])))
+        hj[:K - 1] = stay[:K - 1] * hF1[:K - 1]
+        hj[K - 1] = stay[K - 1] * hFK1
+
+    # probability of reaching query j, i.e. of not having ended before it
+    pj = np.ones(K)
+    pj[1:] = 1 - np.cumsum(hj)[:K - 1]
+    return pj
+
+
+def transition_bands(N, p, q, r, s):
+    """
+    return the non zero part of the first N rows of the transition matrix
+
+    :param p, q, r, s: scalars or per rank arrays
+    :return: a, c, f, g; for document n, a[n] is the backward probability
+        (a[0] = 0), c[n] the forward one (c[N-1] = 0), f[n] the probability
+        of moving to F and g[n] the probability of moving to Q
+    """
+    a, c, f, g = (_ranks(x, N) for x in (q, p, s, r))
+    p1, q1, r1, s1 = c[0], a[0], g[0], f[0]
+    pN, qN, rN, sN = c[-1], a[-1], g[-1], f[-1]
+    a[0], c[0], f[0], g[0] = 0, p1 / (p1 + s1 + r1), s1 / (p1 + s1 + r1), r1 / (p1 + s1 + r1)
+    a[-1], c[-1], f[-1], g[-1] = qN / (qN + sN + rN), 0, sN / (qN + sN + rN), rN / (qN + sN + rN)
+    return a, c, f, g
+
+
+def query_bands(N, K, p, q, r, s):
+    """
+    return the transition_bands of every query as N x K arrays a, c, f, g,
+    column j holding the bands of query j
+    :param p, q, r, s: scalars, per rank or K x N per query and rank arrays
+    """
+    params = [np.broadcast_to(np.asarray(x, dtype=float), (K, N)) for x in (p, q, r, s)]
+    bands = [transition_bands(N, *(x[j] for x in params)) for j in range(K)]
+    return tuple(np.stack([band[i] for band in bands], axis=1) for i in range(4))
+
+
+def solve_tridiagonal(a, c, d):
+    """
+    solve (I - A) x = d with the Thomas algorithm in O(N)
+
+    A is a tridiagonal matrix with zero diagonal, a[n] = A[n, n-1] and
+    c[n] = A[n, n+1]; a[0] and c[N-1] are ignored. I - A is diagonally
+    dominant for the sub-stochastic matrices of MsM, so no pivoting is needed.
+    a, c and d can be N x B arrays of B systems solved at once, column by
+    column.
+    """
+    N = len(d)
+    cp = np.empty(np.shape(d))
+    dp = np.empty(np.shape(d))
+    cp[0] = -c[0]
+    dp[0] = d[0]
+    for n in range(1, N):
+        m = 1 + a[n] * cp[n - 1]
+        cp[n] = -c[n] / m
+        dp[n] = (d[n] + a[n] * dp[n - 1]) / m
+
+    x = np.empty(np.shape(d))
+    x[-1] = dp[-1]
+    for n in range(N - 2, -1, -1):
+        x[n] = dp[n] - cp[n] * x[n + 1]
+    return x
+
+
+def hitting_times(a, c):
+    """
+    ei, the average time to go from document 1 to every document i
+
+    Only forward and backward moves are taken into account (F and Q removed
+    and rows made stochastic again). The time to go from document n to n+1
+    is t[n] = (1 + b[n] t[n-1]) / f[n], with b[n] and f[n] the re-scaled
+    backward and forward probabilities, and ei is the cumulative sum of t.
+    This gives the same values as solving the i x i system
+    (I - Phat(1:i, 1:i)) \ ones(i, 1) of msm_lin.m for every i, in O(N).
+    a and c can be N x B arrays, ei is then N x B too.
+    """
+    N = len(a)
+    ei = np.zeros(np.shape(a))
+    t = 0.0
+    for n in range(N - 1):
+        b, f = a[n] / (a[n] + c[n]), c[n] / (a[n] + c[n])
+        t = (1 + b * t) / f
+        ei[n + 1] = ei[n] + t
+    return ei
+
+
+def msm_chain(N, K, p, q, r, s):
+    """
+    solve the MsM Markov chain for a N x K run in O(N + K), O(N K) with per
+    query parameters
+
+    :param N: number of retrieved documents for each query
+    :param K: number of queries in the session
+    :param p, q, r, s: scalars, per rank or K x N per query and rank arrays
+    :return: ei, eQ, hF, hFK, pj as computed by matlab_msm/msm_lin.m
+        ei: (N,) average time to go from document 1 to document i
+        eQ: average time to go from document 1 to the next query
+        hF: (N,) probability to end the session from document i, first K-1 queries
+        hFK: (N,) probability to end the session from document i, K-th query
+        pj: (K,) probability of reaching query j
+        with per query parameters, ei and hF are N x K and eQ is (K,), a
+        column (value) per query
+    """
+    _check_params(p, q, r, s)
+    _check_shape(N, K)
+
+    if _per_query(N, K, p, q, r, s):
+        # the chains of all the queries are solved at once
+        a, c, f, g = query_bands(N, K, p, q, r, s)
+    else:
+        a, c, f, g = transition_bands(N, p, q, r, s)
+
+    ei = hitting_times(a, c)
+
+    # average time to scan a whole result list and move to the next query,
+    # assuming the session has not ended (F removed, rows re-scaled)
+    z = a + c + g
+    eQ = solve_tridiagonal(a / z, c / z, np.ones(a.shape))[0]
+    eQ = float(eQ) if a.ndim == 1 else eQ
+
+    # probability to go from document i to F in the first K-1 queries
+    hF = solve_tridiagonal(a, c, f)
+
+    # probability to go from document i to F in the K-th query, where there
+    # is no next query (Q removed, rows re-scaled)
+    z = a + c + f
+    hFK = solve_tridiagonal(a / z, c / z, f / z)
+    if a.ndim == 2:
+        hFK = hFK[:, -1]
+
+    pj = _query_probs(hF[0], hFK[0], K)
+
+    return ei, eQ, hF, hFK, pj
+
+
+def msm_chain_dense(N, K, p, q, r, s):
+    """
+    reference implementation of msm_chain, a line by line port of the dense
+    linear systems of msm_lin.m; O(N^4), use it only to validate msm_chain
+    """
+    _check_params(p, q, r, s)
+    _check_shape(N, K)
+
+    if _per_query(N, K, p, q, r, s):
+        params = [np.broadcast_to(np.asarray(x, dtype=float), (K, N)) for x in (p, q, r, s)]
+        chains = [_chain_dense(N, *(x[j] for x in params)) for j in range(K)]
+        ei, eQ, hF, hFK = (np.stack([chain[i] for chain in chains], axis=-1)
+                           for i in range(4))
+        hFK = hFK[:, -1]
+    else:
+        ei, eQ, hF, hFK = _chain_dense(N, p, q, r, s)
+
+    pj = _query_probs(hF[0], hFK[0], K)
+
+    return ei, eQ, hF, hFK, pj
+
+
+def _chain_dense(N, p, q, r, s):
+    """ei, eQ, hF, hFK of msm_chain_dense for scalar or per rank parameters"""
+    P = transition_matrix(N, p, q, r, s)
+    F, Q = N, N + 1
+
+    # average time to go from document 1 to document i, assuming that
+    # neither the session has ended nor we moved to the next query
+    Phat = _stochastic(np.delete(np.delete(P, [F, Q], axis=0), [F, Q], axis=1))
+    ei = np.zeros(N)
+    for i in range(1, N):
+        tmp = np.linalg.solve(np.eye(i) - Phat[:i, :i], np.ones(i))
+        ei[i] = tmp[0]
+
+    # average time to scan a whole result list and move to the next query,
+    # assuming the session has not ended
+    Phat = _stochastic(np.delete(np.delete(P, F, axis=0), F, axis=1))
+    eQ = float(np.linalg.solve(np.eye(N) - Phat[:N, :N], np.ones(N))[0])
+
+    # probability to go from document i to F in the first K-1 queries
+    hF = np.linalg.solve(np.eye(N) - P[:N, :N], P[:N, F])
+
+    # probability to go from document i to F in the K-th query, where there
+    # is no next query
+    Phat = _stochastic(np.delete(np.delete(P, Q, axis=0), Q, axis=1))
+    hFK = np.linalg.solve(np.eye(N) - Phat[:N, :N], Phat[:N, F])
+
+    return ei, eQ, hF, hFK
+
+
+def check_chain(N, K, p, q, r, s, rtol=1e-10):
+    """
+    compare msm_chain with msm_chain_dense and raise AssertionError if a
+    result differs by more than rtol, relative to its magnitude, or if
+    either of them is not finite
+    With q > p the hitting times ei grow geometrically with the rank and the
+    dense solves lose as many digits (their error is about eps * max(ei)),
+    so the difference of ei only is also divided by max(1, max(ei)); past
+    max(ei) ~ 1 / eps the dense ei has no correct digit left to check.
+    :return: largest relative difference of eQ, hF, hFK and pj, and that of
+        ei divided by max(1, max(ei))
+    """
+    dense = msm_chain_dense(N, K, p, q, r, s)
+    errs = {}
+    for name, x, y in zip(('ei', 'eQ', 'hF', 'hFK', 'pj'), msm_chain(N, K, p, q, r, s), dense):
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        assert np.all(np.isfinite(y)), 'the dense solve of %s is not finite' % name
+        assert np.all(np.isfinite(x)), 'msm_chain %s is not finite' % name
+        scale = float(np.max(np.abs(y)))
+        errs[name] = float(np.max(np.abs(x - y))) / (scale if scale > 0 else 1.0)
+    errs['ei'] /= max(1.0, float(np.max(dense[0])))
+    for name, err in errs.items():
+        assert err <= rtol, 'msm_chain %s differs from the dense solve by %g' % (name, err)
+    return max(errs[name] for name in ('eQ', 'hF', 'hFK', 'pj')), errs['ei']
+
+
+def expected_time(ei, eQ, K):
+    """
+    N x K average time to reach every document of the session, plus one;
+    ei is N x K and eQ (K,) with per query parameters, see msm_chain
+    """
+    if np.ndim(eQ) == 0:
+        return 1 + ei[:, np.newaxis] + np.arange(K)[np.newaxis, :] * eQ
+    # time to scan the lists of all the queries before
+    return 1 + ei + np.concatenate(([0], np.cumsum(eQ)[:K - 1]))[np.newaxis, :]
+
+
+class DiscountPlan:
+    """
+    MsM discount weights of one (p, q, r, s) configuration for N x K runs,
+    with scalar, per rank or per query and rank parameters
+
+    Everything MsM computes but the gain depends only on the configuration
+    and on the shape of the run, so the chain is solved once and scoring a
+    run reduces to sum(run * W) with the N x K weight matrix W of a variant:
+        lin:     pj / (1 + ei + (j-1) eQ)
+        log:     pj / (1 + log(1 + ei + (j-1) eQ))
+        log_inc: pj * (1 + log(1 + ei + (j-1) eQ))
+    """
+
+    def __init__(self, N, K, p, q, r, s):
+        self.shape = (N, K)
+        self.config = (p, q, r, s)
+        self.ei, self.eQ, self.hF, self.hFK, self.pj = msm_chain(N, K, p, q, r, s)
+
+        t = expected_time(self.ei, self.eQ, K)
+        self.weights = {
+            'lin': self.pj / t,
+            'log': self.pj / (1 + np.log(t)),
+            'log_inc': self.pj * (1 + np.log(t)),
+        }
+        self._freeze()
+
+    def _freeze(self):
+        # plans are shared between runs, do not let anyone change them
+        for a in (self.ei, self.hF, self.hFK, self.pj) + tuple(self.weights.values()):
+            a.setflags(write=False)
+        if isinstance(self.eQ, np.ndarray):
+            self.eQ.setflags(write=False)
+
+    def arrays(self):
+        """return the solved chain and the weights as {name: array}, see from_arrays"""
+        arrays = {'ei': self.ei, 'eQ': np.asarray(self.eQ, dtype=np.float64), 'hF': self.hF,
+                  'hFK': self.hFK, 'pj': self.pj}
+        arrays.update(self.weights)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, N, K, p, q, r, s, arrays):
+        """rebuild the DiscountPlan of arrays() without solving the chain again"""
+        plan = cls.__new__(cls)
+        plan.shape = (N, K)
+        plan.config = (p, q, r, s)
+        plan.ei, plan.hF, plan.hFK, plan.pj = (np.array(arrays[name])
+                                               for name in ('ei', 'hF', 'hFK', 'pj'))
+        eQ = np.array(arrays['eQ'])
+        plan.eQ = float(eQ) if eQ.ndim == 0 else eQ
+        plan.weights = {v: np.array(arrays[v]) for v in VARIANTS}
+        plan._freeze()
+        return plan
+
+    def score(self, run, variant='lin'):
+        """return the MsM value of a N x K run"""
+        return float(np.sum(run * self.weights[variant]))
+
+    def score_prefixes(self, run, variant='lin'):
+        """
+        return the MsM values of the first k queries of a N x K run, k = 1..K
+
+        ei, eQ and the first k values of pj do not depend on K (nor on the
+        parameters of the queries after k), so the weights
+        of a N x k run are the first k columns of the N x K weights and the
+        values are the prefix sums of the weighted columns
+        """
+        return np.cumsum(np.sum(run * self.weights[variant], axis=0))
+
+
+_plans = PlanCache(DiscountPlan, maxsize=1024)
+
+
+def set_plan_cache(path=None, maxsize=1024, max_bytes=256 << 20):
+    """
+    replace the cache of discount_plan, see plan_cache.PlanCache
+    :param path: directory where the plans are persisted, None to keep them
+        in memory only
+    """
+    global _plans
+    _plans = PlanCache(DiscountPlan, maxsize, path, max_bytes)
+    return _plans
+
+
+def plan_cache_info():
+    """return the hits, misses and evictions of the cache of discount_plan"""
+    return _plans.info()
+
+
+def discount_plan(N, K, p, q, r, s):
+    """return the (cached) DiscountPlan of a configuration and run shape"""
+    return _plans.get((N, K, p, q, r, s))
+
+
+def _msm(run, p, q, r, s, variant):
+    run = _check_run(run)
+    N, K = run.shape
+    return discount_plan(N, K, p, q, r, s).score(run, variant)
+
+
+def msm_lin(run, p, q, r, s):
+    """MsM with the gain discounted by the average time to reach a document"""
+    return _msm(run, p, q, r, s, 'lin')
+
+
+def msm_log(run, p, q, r, s):
+    """MsM with the gain discounted by the log of the average time"""
+    return _msm(run, p, q, r, s, 'log')
+
+
+def msm_log_inc(run, p, q, r, s):
+    """MsM with the gain increased by the log of the average time"""
+    return _msm(run, p, q, r, s, 'log_inc')
+
+
+def _grid_values(name, value):
+    if value == 'rest':
+        return None
+    parts = value.split(':')
+    if len(parts) == 1:
+        return [float(parts[0])]
+    if len(parts) != 3:
+        raise ValueError('%s: expected value or start:stop:step, got %r' % (name, value))
+    start, stop, step = map(float, parts)
+    if step <= 0 or stop < start:
+        raise ValueError('%s: empty range %r' % (name, value))
+    n = int(round((stop - start) / step)) + 1
+    return [round(start + i * step, 10) for i in range(n)]
+
+
+def parameter_grid(spec):
+    """
+    expand a grid spec into the list of (p, q, r, s) configurations
+
+    spec is a comma or whitespace separated list of name=value, where
+    value is a number, a start:stop:step range (stop included) or 'rest'
+    for at most one parameter, which is then set to 1 minus the others.
+    Configurations where p + q + r + s != 1 or where a parameter is out of
+    its range are dropped, e.g. 'p=0.05:0.9:0.05 q=0 r=0.05:0.9:0.05 s=rest'
+    """
+    values = {}
+    for item in spec.replace(',', ' ').split():
+        name, _, value = item.partition('=')
+        if name not in 'pqrs' or len(name) != 1:
+            raise ValueError('unknown parameter %r' % name)
+        values[name] = _grid_values(name, value.strip())
+    if sorted(values) != ['p', 'q', 'r', 's']:
+        raise ValueError('the grid must define p, q, r and s')
+    rest = [name for name, v in values.items() if v is None]
+    if len(rest) > 1:
+        raise ValueError('only one parameter can be rest')
+
+    configs = []
+    fixed = [name for name in 'pqrs' if values[name] is not None]
+    for combo in itertools.product(*(values[name] for name in fixed)):
+        cfg = dict(zip(fixed, combo))
+        if rest:
+            cfg[rest[0]] = round(1 - sum(combo), 10)
+        cfg = tuple(cfg[name] for name in 'pqrs')
+        if abs(sum(cfg) - 1) > 1e-9:
+            continue
+        try:
+            _check_params(*cfg)
+        except ValueError:
+            continue
+        configs.append(cfg)
+    return configs
+
+
+def weight_tensor(configs, N, K, variants=VARIANTS):
+    """(V, C, N, K) weight matrices of every variant and configuration"""
+    return np.stack([np.stack([discount_plan(N, K, *cfg).weights[v] for cfg in configs])
+                     for v in variants])
+
+
+def score_tensor(runs, weights):
+    """
+    score a stack of runs under a stack of weight matrices at once
+
+    :param runs: (M, N, K) relevance matrices
+    :param weights: (V, C, N, K) output of weight_tensor
+    :return: (V, C, M) MsM values
+    """
+    return np.einsum('mnk,vcnk->vcm', runs, weights, optimize=True)
+
+
+def score_tensor_prefixes(runs, weights):
+    """
+    score_tensor of the first k queries of the runs, for k = 1..K
+
+    :return: (V, C, M, K) MsM values, see DiscountPlan.score_prefixes
+    """
+    return np.cumsum(np.einsum('mnk,vcnk->vcmk', runs, weights, optimize=True), axis=-1)
+
+
+def sorted_weights(weights, m):
+    """
+    the m largest weights of every weight matrix in desc order, by partial sort
+
+    :param weights: (..., N, K) weight matrices, e.g. output of weight_tensor
+    :return: (..., min(m, N K))
+    """
+    flat = weights.reshape(weights.shape[:-2] + (-1,))
+    m = min(m, flat.shape[-1])
+    if 0 < m < flat.shape[-1]:
+        flat = -np.partition(-flat, m - 1, axis=-1)[..., :m]
+    return -np.sort(-flat[..., :m], axis=-1)
+
+
+def ideal_tensor(gains, weights):
+    """
+    value of the ideal run of every topic under a stack of weight matrices
+
+    The ideal run places the judged gains of a topic, in desc order, into
+    the N x K positions with the largest weights; no run of the topic can
+    score more, since a doc is retrieved at most once and weights are positive.
+
+    :param gains: (T, L) judged gains of every topic in desc order, 0 padded
+        (see scoring/scorer/matrix_store.ideal_gains)
+    :param weights: (V, C, N, K) output of weight_tensor
+    :return: (V, C, T) upper bounds of score_tensor
+    """
+    gains = np.asarray(gains, dtype=float)
+    # only the positions of the positive gains matter
+    m = int((gains > 0).sum(axis=1).max()) if gains.size else 0
+    top = sorted_weights(weights, m)
+    return np.einsum('vcl,tl->vct', top, gains[:, :top.shape[-1]])
+
+
+class IdealBounds:
+    """
+    table=
+    {
+        (topic, N, K, p, q, r, s): {variant: value of the ideal run}
+    }
+    Upper bounds of MsM used to normalize it (nMsM = MsM / bound), computed
+    once per topic, configuration and run shape, see ideal_tensor
+    """
+
+    def __init__(self, gains, source=None):
+        """
+        :param gains: {topic: judged gains in desc order, 0 padded}, a
+            missing topic has none
+        :param source: anything identifying where the gains come from
+        """
+        self.gains = gains
+        self.source = source
+        self.table = {}
+
+    def build(self, topics, configs, N, K, cutoffs=None):
+        """
+        compute the bounds of the topics under every configuration at once
+        :param cutoffs: also the bounds of the N x k runs of every cutoff k,
+            whose weights are the first k columns of the N x K ones
+        """
+        configs = [cfg for cfg in configs
+                   if any((topic,) + _normalize((N, k) + tuple(cfg)) not in self.table
+                          for topic in topics for k in cutoffs or [K])]
+        if not configs:
+            return
+        # a topic without ideal gains (e.g. without subtopics) has no positive
+        # gain, its bounds are 0
+        for topic in topics:
+            if topic not in self.gains:
+                for cfg in configs:
+                    for k in cutoffs or [K]:
+                        self.table[(topic,) + _normalize((N, k) + tuple(cfg))] = \
+                            {v: 0.0 for v in VARIANTS}
+        topics = [topic for topic in topics if topic in self.gains]
+        if not topics:
+            return
+        gains = np.stack([self.gains[topic] for topic in topics])
+        weights = weight_tensor(configs, N, K)
+        for k in cutoffs or [K]:
+            bounds = ideal_tensor(gains, weights[..., :k])
+            for c, cfg in enumerate(configs):
+                for i, topic in enumerate(topics):
+                    self.table[(topic,) + _normalize((N, k) + tuple(cfg))] = \
+                        {v: float(bounds[j, c, i]) for j, v in enumerate(VARIANTS)}
+
+    def bound(self, topic, N, K, p, q, r, s):
+        """return {variant: bound} of a topic"""
+        key = (topic,) + _normalize((N, K, p, q, r, s))
+        if key not in self.table:
+            self.build([topic], [(p, q, r, s)], N, K)
+        return self.table[key]
+
+    def normalize(self, value, topic, N, K, p, q, r, s, variant='lin'):
+        """return value / bound, 0 if the topic has no positive gain"""
+        bound = self.bound(topic, N, K, p, q, r, s)[variant]
+        return value / bound if bound != 0 else 0.0
@@ -0,0 +1,143 @@
+"""
+Persistent LRU cache of MsM discount plans
+Solved chains and weight matrices are kept in a bounded in-memory LRU and,
+if a directory is given, in a size-limited on-disk LRU shared by processes
+and sessions: one .npz file per (N, K, p, q, r, s), the least recently used
+files (by mtime, touched on every hit) are removed first
+"""
+import os
+import hashlib
+import zipfile
+from collections import OrderedDict, namedtuple
+import numpy as np
+
+CacheInfo = namedtuple('CacheInfo', 'hits disk_hits misses evictions disk_evictions '
+                                    'currsize maxsize')
+
+
+def _param(x):
+    """float of a scalar parameter, tuple (of tuples) of floats of a per rank (query) one"""
+    if np.ndim(x) == 0:
+        return float(x)
+    return tuple(_param(y) for y in x)
+
+
+def _normalize(key):
+    """
+    hashable (N, K, p, q, r, s) with ints and floats, so 0 and 0.0 are the
+    same entry
+    """
+    N, K, p, q, r, s = key
+    return (int(N), int(K)) + tuple(_param(x) for x in (p, q, r, s))
+
+
+class PlanCache:
+    """
+    LRU cache of factory(*key) for keys (N, K, p, q, r, s)
+    factory is a class whose instances have arrays() -> {name: array} and
+    which rebuilds an instance with factory.from_arrays(*key, arrays), e.g.
+    msm.DiscountPlan
+    """
+
+    def __init__(self, factory, maxsize=1024, path=None, max_bytes=256 << 20):
+        """
+        :param maxsize: number of plans kept in memory
+        :param path: directory of the on-disk cache, None to keep plans in memory only
+        :param max_bytes: size limit of the on-disk cache
+        """
+        self.factory = factory
+        self.maxsize = maxsize
+        self.path = path
+        self.max_bytes = max_bytes
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self._plans = OrderedDict()
+        self.hits = self.disk_hits = self.misses = 0
+        self.evictions = self.disk_evictions = 0
+
+    def get(self, key):
+        """return the plan of key, from memory, from disk or solved"""
+        key = _normalize(key)
+        plan = self._plans.get(key)
+        if plan is not None:
+            self._plans.move_to_end(key)
+            self.hits += 1
+            return plan
+
+        plan = self._load(key) if self.path is not None else None
+        if plan is not None:
+            self.disk_hits += 1
+        else:
+            self.misses += 1
+            plan = self.factory(*key)
+            if self.path is not None:
+                self._save(key, plan)
+
+        self._plans[key] = plan
+        if len(self._plans) > self.maxsize:
+            self._plans.popitem(last=False)
+            self.evictions += 1
+        return plan
+
+    def info(self):
+        return CacheInfo(self.hits, self.disk_hits, self.misses, self.evictions,
+                         self.disk_evictions, len(self._plans), self.maxsize)
+
+    def clear(self):
+        """forget the plans kept in memory and the statistics, not the files"""
+        self._plans.clear()
+        self.hits = self.disk_hits = self.misses = 0
+        self.evictions = self.disk_evictions = 0
+
+    def _file(self, key):
+        return os.path.join(self.path, 'plan-' + hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+                            + '.npz')
+
+    def _load(self, key):
+        file = self._file(key)
+        try:
+            with np.load(file) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError, EOFError, zipfile.BadZipFile):
+            # a broken entry is solved and written again
+            return None
+        if str(arrays.pop('key')) != repr(key):
+            return None
+        try:
+            os.utime(file)
+        except OSError:
+            pass
+        return self.factory.from_arrays(*key, arrays)
+
+    def _save(self, key, plan):
+        file = self._file(key)
+        # write to a temporary file first so readers never see half an entry
+        tmp_file = file[:-len('.npz')] + '.tmp%d.npz' % os.getpid()
+        np.savez(tmp_file, key=np.array(repr(key)), **plan.arrays())
+        os.replace(tmp_file, file)
+        self._shrink()
+
+    def _shrink(self):
+        """remove the least recently used files until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.startswith('plan-') or '.tmp' in name:
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                # removed by another process meanwhile
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+                self.disk_evictions += 1
+            except OSError:
+                pass
+            total -= size
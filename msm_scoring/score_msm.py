@@ -3,77 +3,388 @@
 import sys
 import os
 import io
-from oct2py import octave
 import pickle
 import argparse
+import ast
+from collections import namedtuple
+import numpy as np
+import msm
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'scoring'))
+from scorer.matrix_store import *
+from scorer.manifest import *
+from scorer.cache import file_hash
 
-def write_measurements(out_f, track, year, run, topic, MsM_lin, MsM_log):
+
+def write_measurements(out_f, track, year, run, topic, MsM_lin, MsM_log, cutoff=None,
+                       nMsM=None):
     # write measurements
-    out_f.write(
+    out_f.write((
     '{track}\t{year}\t{run}\t{topic}'
+    + ('\t{cutoff}' if cutoff is not None else '') +
     '\t{MsM_lin}\t{MsM_log}'
-    '\n'.format(
+    + ('\t{nMsM[0]}\t{nMsM[1]}' if nMsM is not None else '') +
+    '\n').format(
         track = track,
         year = year,
         run = run,
         topic = topic,
+        cutoff = cutoff,
         MsM_lin = MsM_lin,
-        MsM_log = MsM_log
+        MsM_log = MsM_log,
+        nMsM = nMsM
         ))#.decode('utf-8'))
 
+
+def _pickle_files(matrices_path):
+    return [f for f in os.listdir(matrices_path)
+            if f.endswith('m') and f.split('__')[3] != 'max']
+
+
+def load_pickles(matrices_path):
+    """legacy layout, one pickled sum matrix per topic-run"""
+    keys, matrices = [], []
+    for topic_run in _pickle_files(matrices_path):
+        tr = topic_run.split('__')
+        track = tr[0]
+        year = tr[1]
+        run = tr[2]
+        topic = tr[4][:-2]
+
+        f = open(os.path.join(matrices_path, topic_run), 'rb')
+        topic_matrix = pickle.load(f)
+        f.close()
+        keys.append((track, year, run, topic))
+        matrices.append(topic_matrix)
+    return keys, matrices
+
+
+def load_matrices(matrices_path):
+    """
+    return [(keys, (M, N, K) tensor)], one block per matrix store (memory
+    mapped) plus one block for the legacy pickled matrices, if any
+    """
+    blocks = [read_store(path) for path in list_stores(matrices_path)]
+    keys, matrices = load_pickles(matrices_path)
+    if keys:
+        shapes = set(np.shape(topic_matrix) for topic_matrix in matrices)
+        if len(shapes) > 1:
+            raise ValueError('all topic matrices must have the same shape')
+        blocks.append((keys, np.asarray(matrices)))
+    return blocks
+
+
+def load_ideal(matrices_path):
+    """
+    return the IdealBounds of the ideal gains of every topic of the stores
+    in matrices_path, None if there are none
+    """
+    paths = list_ideals(matrices_path)
+    if not paths:
+        return None
+    return msm.IdealBounds(read_ideal(matrices_path),
+                           [[os.path.basename(path), file_hash(path),
+                             file_hash(path[:-len(IDEAL_SUFFIX)] + IDEAL_INDEX_SUFFIX)]
+                            for path in paths])
+
+
+def _topic(key):
+    """(track, year, topic) of a (track, year, run, topic) key"""
+    return key[0], key[1], key[3]
+
+
+def normalize(ideal, keys, cfg, N, cutoffs, scores):
+    """
+    return nMsM, scores divided by the ideal values of the topics of keys (0
+    if a topic has no positive gain)
+    :param scores: (V, M, len(cutoffs)) MsM values of every variant, key and cutoff
+    """
+    ideal.build(sorted(set(map(_topic, keys))), [cfg], N, max(cutoffs), cutoffs)
+    bounds = np.array([[[ideal.bound(_topic(key), N, k, *cfg)[v] for k in cutoffs]
+                        for key in keys] for v in msm.VARIANTS[:len(scores)]])
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(bounds != 0, np.asarray(scores, dtype=float) / bounds, 0.0)
+
+
+def block_sources(matrices_path):
+    """
+    return [(name, content hash of the files)] of the blocks of
+    load_matrices, in the same order
+    """
+    sources = [(os.path.basename(path),
+                [file_hash(path), file_hash(path[:-len(STORE_SUFFIX)] + INDEX_SUFFIX)])
+               for path in list_stores(matrices_path)]
+    files = sorted(_pickle_files(matrices_path))
+    if files:
+        sources.append(('pickles', [[f, file_hash(os.path.join(matrices_path, f))]
+                                    for f in files]))
+    return sources
+
+
+def _eval_file(out_path, cfg_id, all_cutoffs):
+    return os.path.join(out_path, cfg_id + ('.cutoffs.eval' if all_cutoffs else '.eval'))
+
+
+# what is left to do for the .eval file of a configuration:
+# manifest: Manifest of the file, None if not incremental
+# old: {block name: rows of the block in the file}
+# stale: indices of the blocks to score
+# rewrite: if the file needs to be written at all
+Plan = namedtuple('Plan', 'manifest old stale rewrite')
+
+
+def _plan(out_file, blocks, sources, config, all_cutoffs):
+    """
+    return the Plan of out_file
+    :param sources: block_sources of the blocks, None to score every block
+    :param config: everything but the matrices the rows depend on
+    :param all_cutoffs: if the file has a row per cutoff of every matrix
+    """
+    if sources is None:
+        return Plan(None, {}, list(range(len(blocks))), True)
+    manifest = Manifest(out_file + MANIFEST_SUFFIX)
+    key_block = {key: name for (name, _), (keys, _) in zip(sources, blocks) for key in keys}
+    _, old = group_rows(out_file, lambda fields: key_block.get(tuple(fields[:4])))
+    stale = []
+    for b, (name, digest) in enumerate(sources):
+        print_ = fingerprint(digest, config)
+        keys, runs = blocks[b]
+        # a block without matrices has no rows but is recorded all the same
+        rows = len(keys) * (runs.shape[-1] if all_cutoffs else 1)
+        if not manifest.unchanged(name, print_, len(old.get(name, ()))):
+            stale.append(b)
+        manifest.record(name, print_, rows)
+    # rows of blocks that are gone are dropped
+    removed = set(old) - set(name for name, _ in sources)
+    return Plan(manifest, old, stale, bool(stale or removed))
+
+
+def _write_eval(out_file, header, names, lines, plan):
+    """write the fresh lines of the stale blocks and the old lines of the others"""
+    with io.open(out_file, 'w', encoding='utf8') as out_f:
+        out_f.write(header)
+        for b, name in enumerate(names):
+            out_f.writelines(lines[b] if b in lines else plan.old.get(name, []))
+    if plan.manifest is not None:
+        plan.manifest.save()
+
+
+def sweep(out_path, blocks, configs, all_cutoffs=False, sources=None, ideal=None):
+    """
+    score every matrix under every configuration with a single einsum per block
+    :param all_cutoffs: write the value at every cutoff 1..K, one row per cutoff
+    :param sources: block_sources of the blocks, to only score the blocks
+        whose matrices changed since the last sweep (see scorer/manifest.py)
+    :param ideal: IdealBounds (see load_ideal), to also write nMsM
+    """
+    names = [name for name, _ in sources] if sources is not None else list(range(len(blocks)))
+    cfg_ids = ['MsM_%g_%g_%g_%g' % cfg for cfg in configs]
+    normalized = (('normalized', ideal.source),) if ideal is not None else ()
+    plans = [_plan(_eval_file(out_path, cfg_id, all_cutoffs), blocks, sources,
+                   ('grid', cfg, all_cutoffs) + normalized, all_cutoffs)
+             for cfg_id, cfg in zip(cfg_ids, configs)]
+
+    # every block is scored under the configurations it is stale for
+    scores = []
+    for b, (_, runs) in enumerate(blocks):
+        todo = [c for c, plan in enumerate(plans) if b in plan.stale]
+        if not todo:
+            scores.append({})
+            continue
+        N, K = runs.shape[1:]
+        weights = msm.weight_tensor([configs[c] for c in todo], N, K)
+        if ideal is not None:
+            # the ideal values of the stale configurations in one einsum
+            ideal.build(sorted(set(map(_topic, blocks[b][0]))), [configs[c] for c in todo],
+                        N, K, range(1, K + 1) if all_cutoffs else None)
+        if all_cutoffs:
+            block_scores = msm.score_tensor_prefixes(runs, weights)
+        else:
+            # a single cutoff, K
+            block_scores = msm.score_tensor(runs, weights)[..., None]
+        scores.append({c: block_scores[:, i] for i, c in enumerate(todo)})
+
+    for c, cfg_id in enumerate(cfg_ids):
+        if not plans[c].rewrite:
+            continue
+        lines = {}
+        for b in plans[c].stale:
+            (keys, runs), config_scores = blocks[b], scores[b][c]
+            if ideal is not None:
+                N, K = runs.shape[1:]
+                cutoffs = list(range(1, K + 1)) if all_cutoffs else [K]
+                config_scores = np.concatenate(
+                    [config_scores, normalize(ideal, keys, configs[c], N, cutoffs, config_scores)])
+            lines[b] = ['\t'.join(list(key) + ([str(k + 1)] if all_cutoffs else []) +
+                                   [str(float(v)) for v in config_scores[:, m, k]]) + '\n'
+                        for m, key in enumerate(keys) for k in range(config_scores.shape[-1])]
+        _write_eval(_eval_file(out_path, cfg_id, all_cutoffs),
+                    'dataset\tyear\trun\ttopic' + ('\tcutoff' if all_cutoffs else '') +
+                    '\t' + cfg_id + '_lin'
+                    '\t' + cfg_id + '_log\t' + cfg_id + '_log_inc' +
+                    ('\tn' + cfg_id + '_lin\tn' + cfg_id + '_log\tn' + cfg_id + '_log_inc'
+                     if ideal is not None else '') + '\n',
+                    names, lines, plans[c])
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--matlab_path', type=str, required=True)
+    parser.add_argument('--matlab_path', type=str)
     parser.add_argument('--out_path', type=str, required=True)
     parser.add_argument('--matrices_path', type=str, required=True)
-    parser.add_argument('--config_file', type=str, required=True)    
-    
+    configs = parser.add_mutually_exclusive_group(required=True)
+    # {cfg_id: [p, q, r, s]}, each a number, a list per rank or a list of
+    # lists per query and rank (numpy engine only)
+    configs.add_argument('--config_file', type=str)
+    # sweep a grid of configurations, e.g. 'p=0.05:0.9:0.05 q=0 r=0.05:0.9:0.05 s=rest'
+    configs.add_argument('--grid', type=str)
+
+    # numpy=native MsM engine, octave=matlab_msm code through oct2py
+    parser.add_argument('--engine', type=str, choices=['numpy', 'octave'],
+                        default='numpy')
+
+    # score at every cutoff 1..K of the matrices, one row per cutoff
+    parser.add_argument('--all_cutoffs', '--all-cutoffs', action='store_true')
+
+    # only score the matrix stores that changed since the last run (see
+    # scorer/manifest.py) and keep the rows of the others
+    parser.add_argument('--incremental', action='store_true')
+
+    # also write nMsM, MsM divided by the value of the ideal run of the topic
+    # (needs the ideal gains written by generate_msm_matrices.py)
+    parser.add_argument('--normalized', action='store_true')
+
+    # directory where the solved MsM chains and weights are persisted between
+    # runs, and its size limit in MB
+    parser.add_argument('--plan_cache_path', type=str)
+    parser.add_argument('--plan_cache_mb', type=int, default=256)
 
     args = parser.parse_args()
     matlab_path = args.matlab_path
     out_path = args.out_path
     matrices_path = args.matrices_path
     config_file = args.config_file
+    grid = args.grid
+    engine = args.engine
+    all_cutoffs = args.all_cutoffs
+    incremental = args.incremental
+    if args.plan_cache_path is not None:
+        msm.set_plan_cache(args.plan_cache_path, max_bytes=args.plan_cache_mb << 20)
+
+    blocks = load_matrices(matrices_path)
+    sources = block_sources(matrices_path) if incremental else None
+    names = [name for name, _ in sources] if incremental else list(range(len(blocks)))
+
+    ideal = None
+    if args.normalized:
+        ideal = load_ideal(matrices_path)
+        if ideal is None:
+            parser.error('--normalized: no ideal gains in %s, regenerate the matrices'
+                         % matrices_path)
+        # e.g. topics without subtopics, their nMsM is 0
+        topics = set(_topic(key) for keys, _ in blocks for key in keys)
+        missing = topics - set(ideal.gains)
+        if missing:
+            print('--normalized: no ideal gains of %d topics (e.g. %s), their nMsM is 0'
+                  % (len(missing), ', '.join('/'.join(topic) for topic in sorted(missing)[:3])))
+
+    if grid is not None:
+        if engine != 'numpy':
+            parser.error('--grid is only available with --engine numpy')
+        configs = msm.parameter_grid(grid)
+        print('%d configurations, %d topic matrices' % \
+              (len(configs), sum(len(keys) for keys, _ in blocks)))
+        sweep(out_path, blocks, configs, all_cutoffs, sources, ideal)
+        print(msm.plan_cache_info())
+        return
+
+    if engine == 'octave':
+        if matlab_path is None:
+            parser.error('--matlab_path is required with --engine octave')
+        from oct2py import octave
+        octave.addpath(matlab_path)
+
+        def score(topic_matrix, p, q, r, s):
+            if any(np.ndim(x) for x in (p, q, r, s)):
+                raise ValueError('per rank and per query p, q, r, s need --engine numpy')
+            return (octave.msm_lin(topic_matrix, p, q, r, s),
+                    octave.msm_log(topic_matrix, p, q, r, s))
 
-    octave.addpath(matlab_path)
+        def score_prefixes(topic_matrix, p, q, r, s):
+            # the matlab code has no prefix form, score every truncated matrix
+            topic_matrix = np.asarray(topic_matrix)
+            return list(zip(*[score(topic_matrix[:, :k], p, q, r, s)
+                              for k in range(1, topic_matrix.shape[1] + 1)]))
+    else:
+        def score(topic_matrix, p, q, r, s):
+            # the chain is solved once per config and matrix shape
+            topic_matrix = np.asarray(topic_matrix)
+            plan = msm.discount_plan(*topic_matrix.shape, p, q, r, s)
+            return plan.score(topic_matrix, 'lin'), plan.score(topic_matrix, 'log')
+
+        def score_prefixes(topic_matrix, p, q, r, s):
+            topic_matrix = np.asarray(topic_matrix)
+            plan = msm.discount_plan(*topic_matrix.shape, p, q, r, s)
+            return (plan.score_prefixes(topic_matrix, 'lin').tolist(),
+                    plan.score_prefixes(topic_matrix, 'log').tolist())
 
     with open(config_file,'r') as msm_f:
-        msm_configs = eval(msm_f.read())
+        msm_configs = ast.literal_eval(msm_f.read())
 
     # run linear and logarithmic variants
     # matlab function format: [m] = msm(run, p, q, r, s)
     for cfg in msm_configs.items():
         cfg_id = cfg[0]
         p,q,r,s = cfg[1]
+        print(cfg_id)
+
+        out_file = _eval_file(out_path, cfg_id, all_cutoffs)
+        plan = _plan(out_file, blocks, sources, ('config', cfg_id, [p, q, r, s], engine, all_cutoffs)
+                     + ((('normalized', ideal.source),) if ideal is not None else ()), all_cutoffs)
+        if not plan.rewrite:
+            continue
+
+        lines = {}
+        for b in plan.stale:
+            keys, runs = blocks[b]
+            N, K = runs.shape[1:]
+            if ideal is not None:
+                ideal.build(sorted(set(map(_topic, keys))), [(p, q, r, s)], N, K,
+                            range(1, K + 1) if all_cutoffs else None)
+            out_f = io.StringIO()
+            for key, topic_matrix in zip(keys, runs):
+                track, year, run, topic = key
+                if all_cutoffs:
+                    for k, (m_lin, m_log) in enumerate(zip(*score_prefixes(topic_matrix, p,q,r,s))):
+                        nMsM = None
+                        if ideal is not None:
+                            nMsM = [ideal.normalize(m, _topic(key), N, k + 1, p, q, r, s, v)
+                                    for m, v in ((m_lin, 'lin'), (m_log, 'log'))]
+                        write_measurements(out_f, track, year, run, topic, m_lin, m_log, k + 1,
+                                           nMsM)
+                    continue
 
-        out_file = os.path.join(out_path, cfg_id + '.eval')
-        with io.open(out_file, 'w', encoding='utf8') as out_f:
-            out_f.write('dataset\tyear\trun\ttopic\t' + cfg_id + '_lin'
-                        '\t' + cfg_id + '_log\n' #.decode('utf-8')
-                        )
-
-            topic_runs = [f for f in os.listdir(matrices_path) if f.endswith('m')]
-            for topic_run in topic_runs:
-                tr = topic_run.split('__')
-                track = tr[0]
-                year = tr[1]
-                run = tr[2]
-                rel = tr[3]
-                topic = tr[4][:-2]
-
-                if rel == 'max': continue
-
-                print(topic_run)
-                f = open(matrices_path + topic_run, 'rb')
-                topic_matrix = pickle.load(f)
-                f.close()
-                
                 # score
-                m_lin = octave.msm_lin(topic_matrix, p,q,r,s)
-                m_log = octave.msm_log(topic_matrix, p,q,r,s)
+                m_lin, m_log = score(topic_matrix, p,q,r,s)
+
+                nMsM = None
+                if ideal is not None:
+                    nMsM = [ideal.normalize(m, _topic(key), N, K, p, q, r, s, v)
+                            for m, v in ((m_lin, 'lin'), (m_log, 'log'))]
+                write_measurements(out_f, track, year, run, topic, m_lin, m_log, nMsM=nMsM)
+            lines[b] = out_f.getvalue().splitlines(True)
+
+        _write_eval(out_file,
+                    'dataset\tyear\trun\ttopic' + ('\tcutoff' if all_cutoffs else '') +
+                    '\t' + cfg_id + '_lin'
+                    '\t' + cfg_id + '_log' +
+                    ('\tn' + cfg_id + '_lin\tn' + cfg_id + '_log' if ideal is not None else '') +
+                    '\n', #.decode('utf-8')
+                    names, lines, plan)
 
-                write_measurements(out_f, track, year, run, topic, m_lin, m_log)
+    if engine == 'numpy':
+        print(msm.plan_cache_info())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+Monte Carlo simulation of the MsM user model
+Simulated users walk the N x K result lists of a session with the moves of
+msm.transition_bands: forward (p), backward (q), next query (r) and end of
+the session (s), all of them at once as NumPy state vectors. The walk does
+not depend on the gains, so it is simulated once per configuration and run
+shape and every topic matrix is scored from the first reach time of every
+document, as with the weights of a DiscountPlan.
+"""
+import sys
+import os
+import io
+import argparse
+import ast
+import numpy as np
+import msm
+
+# half width of a 95% normal confidence interval, in standard errors
+Z95 = 1.959963984540054
+
+# discounts of a gain reached after t moves, see Simulation
+SIM_VARIANTS = ('gain',) + msm.VARIANTS
+
+# most documents (users x N x K) walked at once, whatever the chunk
+CHUNK_CELLS = 1 << 24
+
+
+def _discounts(t):
+    """{variant: discount} of first reach times t (number of moves)"""
+    log_t = np.log1p(t)
+    return {'gain': np.ones_like(log_t),
+            'lin': 1 / (1 + t),
+            'log': 1 / (1 + log_t),
+            'log_inc': 1 + log_t}
+
+
+def _tables(first):
+    """
+    {name: table} such that table[first + 1] is the discount (or the time t,
+    time_sq t^2) of every first reach time, 0 for the documents never reached
+    """
+    t = np.arange(int(first.max()) + 1, dtype=float)
+    tables = dict(_discounts(t), time=t, time_sq=t * t)
+    return {name: np.concatenate(([0.0], table)) for name, table in tables.items()}
+
+
+def _thresholds(a, c, f, g):
+    """
+    (3, N) cumulative probabilities of the backward, forward and stop moves
+    of every document, the rest being the move to the next query; the bands
+    are re-scaled to sum up to 1 and a threshold past which nothing can
+    happen is exactly 1
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        # 0 / 0 for a document with no move at all, which is never left
+        thresholds = np.cumsum(np.stack([a, c, f]), axis=0) / (a + c + f + g)
+    rest = np.stack([c + f + g, f + g, g])
+    thresholds[rest == 0] = 1
+    return thresholds
+
+
+def _walk(bands, N, K, users, rng, max_steps):
+    """
+    walk users from document 1 of query 1 until they end the session or can
+    no longer reach a document they have not seen
+    :param bands: (a, c, f, g) of every query, see msm.transition_bands,
+        re-scaled to sum up to 1
+    :return: (users, N, K) first reach times of the documents, in moves
+        from document 1 of query 1, -1 if never reached, and the number of
+        users still walking after max_steps
+    """
+    # (K, 3, N)
+    thresholds = np.stack([_thresholds(*query_bands) for query_bands in bands])
+    first = np.full((users, N, K), -1, dtype=np.int32)
+    first[:, 0, 0] = 0
+
+    user = np.arange(users)
+    pos = np.zeros(users, dtype=np.intp)
+    query = np.zeros(users, dtype=np.intp)
+    # furthest document reached in the current query
+    top = np.zeros(users, dtype=np.intp)
+    for t in range(1, max_steps + 1):
+        if not len(user):
+            break
+        threshold = thresholds[query, :, pos]
+        u = rng.random(len(user))
+        back = u < threshold[:, 0]
+        forward = ~back & (u < threshold[:, 1])
+        next_query = u >= threshold[:, 2]
+
+        pos = np.where(next_query, 0, pos - back + forward)
+        query = query + next_query
+        new = (forward & (pos > top)) | next_query
+        first[user[new], pos[new], query[new]] = t
+        top = np.where(next_query, 0, np.maximum(top, pos))
+
+        walking = (back | forward | next_query) & ~((query == K - 1) & (top == N - 1))
+        user, pos, query, top = user[walking], pos[walking], query[walking], top[walking]
+    return first, len(user)
+
+
+def _walks(bands, N, K, users, rng, chunk, max_steps):
+    """
+    _walk of users in chunks of at most chunk users, and at most CHUNK_CELLS
+    documents, to bound memory
+    """
+    chunk = max(1, min(chunk, CHUNK_CELLS // (N * K)))
+    for start in range(0, users, chunk):
+        yield _walk(bands, N, K, min(chunk, users - start), rng, max_steps)
+
+
+def _query_bands(N, K, p, q, r, s):
+    """[(a, c, f, g)] of every query, without next query after the K-th one"""
+    a, c, f, g = msm.query_bands(N, K, p, q, r, s)
+    g[:, K - 1] = 0
+    return [(a[:, j], c[:, j], f[:, j], g[:, j]) for j in range(K)]
+
+
+class Simulation:
+    """
+    Estimates of the MsM user model of one (p, q, r, s) configuration for
+    N x K runs, from the walks of simulated users:
+    reach: (N, K) probability of reaching every document
+    time: (N, K) average first reach time of every document, in moves from
+        document 1 of query 1, over the users reaching it (nan if none does)
+    pj: (K,) probability of reaching query j, reach[0]
+    weights: {variant: (N, K)} average discount of every document, 0 for
+        the users not reaching it, with the discounts
+            gain:    1
+            lin:     1 / (1 + t)
+            log:     1 / (1 + log(1 + t))
+            log_inc: 1 + log(1 + t)
+        of a document first reached after t moves; the expected gain a user
+        accumulates on a run is sum(run * weights[variant]), see score()
+    reach_ci, time_ci, pj_ci: confidence interval half widths
+    truncated: number of users stopped after max_steps moves
+    """
+
+    def __init__(self, N, K, p, q, r, s, users=10**6, seed=None, z=Z95,
+                 chunk=10**5, max_steps=10**5, covariance=False):
+        """
+        :param seed: seed of the numpy random generator
+        :param z: half width of the confidence intervals, in standard errors
+        :param chunk: number of users walking at once
+        :param covariance: keep the (N*K, N*K) covariance of the discounts of
+            a user for the intervals of score(), instead of their variances
+        """
+        msm._check_params(p, q, r, s)
+        msm._check_shape(N, K)
+        self.shape = (N, K)
+        self.config = (p, q, r, s)
+        self.users = users
+        self.z = z
+        msm._per_query(N, K, p, q, r, s)
+        bands = _query_bands(N, K, p, q, r, s)
+        rng = np.random.default_rng(seed)
+
+        time_sum = np.zeros((N, K))
+        time_sq = np.zeros((N, K))
+        x_sum = {v: np.zeros(N * K) for v in SIM_VARIANTS}
+        # sums of the products of the discounts of every two documents, or of
+        # their squares only
+        xx_sum = {v: np.zeros((N * K, N * K) if covariance else N * K) for v in SIM_VARIANTS}
+        self.truncated = 0
+        for first, truncated in _walks(bands, N, K, users, rng, chunk, max_steps):
+            self.truncated += truncated
+            index = (first + 1).reshape(len(first), N * K)
+            tables = _tables(first)
+            time_sum += tables['time'][index].sum(axis=0).reshape(N, K)
+            time_sq += tables['time_sq'][index].sum(axis=0).reshape(N, K)
+            for v in SIM_VARIANTS:
+                x = tables[v][index]
+                x_sum[v] += x.sum(axis=0)
+                xx_sum[v] += x.T @ x if covariance else (x * x).sum(axis=0)
+
+        # the gain discount is 1 for every document reached
+        reached = x_sum['gain'].reshape(N, K)
+        self.reach = reached / users
+        self.reach_ci = z * np.sqrt(self.reach * (1 - self.reach) / users)
+        self.pj, self.pj_ci = self.reach[0], self.reach_ci[0]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            self.time = time_sum / reached
+            self.time_ci = z * np.sqrt(np.maximum(time_sq / reached - self.time ** 2, 0)
+                                       / reached)
+        self.weights = {v: (x_sum[v] / users).reshape(N, K) for v in SIM_VARIANTS}
+        mean = {v: x_sum[v] / users for v in SIM_VARIANTS}
+        # covariance (variance) of the discounts of a user, for the intervals
+        # of score()
+        self._cov = {v: xx_sum[v] / users - (np.outer(mean[v], mean[v]) if covariance
+                                             else mean[v] ** 2)
+                     for v in SIM_VARIANTS}
+
+    def score(self, runs, variant='lin'):
+        """
+        return the expected accumulated gain of every run and its confidence
+        interval half width; without the covariance of the Simulation, the
+        discounts of the documents are taken as independent, which narrows
+        the intervals as those of a user are positively correlated
+        :param runs: N x K run or (M, N, K) runs
+        :return: values, half widths; floats for a run, (M,) arrays for runs
+        """
+        runs = np.asarray(runs, dtype=float)
+        gains = runs.reshape(-1, runs.shape[-2] * runs.shape[-1])
+        values = gains @ self.weights[variant].reshape(-1)
+        cov = self._cov[variant]
+        if cov.ndim == 2:
+            var = np.einsum('mi,ij,mj->m', gains, cov, gains) / self.users
+        else:
+            var = (gains * gains) @ cov / self.users
+        ci = self.z * np.sqrt(np.maximum(var, 0))
+        if runs.ndim == 2:
+            return float(values[0]), float(ci[0])
+        return values, ci
+
+
+def simulate_chain(N, K, p, q, r, s, users=10**6, seed=None, z=Z95,
+                   chunk=10**5, max_steps=10**5):
+    """
+    estimate what msm.msm_chain computes from simulated walks
+    :return: {'ei': (N,), 'eQ': float, 'pj': (K,)} of (estimate, confidence
+        interval half width); with per query parameters, ei is N x K and eQ
+        (K,), as in msm_chain
+    """
+    msm._check_params(p, q, r, s)
+    msm._check_shape(N, K)
+    per_query = msm._per_query(N, K, p, q, r, s)
+    a, c, f, g = msm.query_bands(N, K, p, q, r, s)
+    zero = np.zeros(N)
+    # the walks end in the last query, which only has to be reached
+    stop = (zero, zero, np.ones(N), zero)
+    rng = np.random.default_rng(seed)
+
+    def mean(x):
+        x = np.concatenate(x).astype(float)
+        return x.mean(axis=0), z * x.std(axis=0) / np.sqrt(len(x))
+
+    ei, eQ = [], []
+    for j in range(K) if per_query else [0]:
+        # forward and backward moves only
+        ei.append(mean([first[:, :, 0] for first, _ in
+                        _walks([(a[:, j], c[:, j], zero, zero)], N, 1, users, rng, chunk,
+                               max_steps)]))
+        # no end of the session, time until the move to the next query
+        eQ.append(mean([first[:, 0, 1] for first, _ in
+                        _walks([(a[:, j], c[:, j], zero, g[:, j]), stop], N, 2, users, rng,
+                               chunk, max_steps)]))
+    pj = mean([first[:, 0, :] >= 0 for first, _ in
+               _walks(_query_bands(N, K, p, q, r, s)[:K - 1] + [stop], N, K, users, rng,
+                      chunk, max_steps)])
+    if not per_query:
+        return {'ei': ei[0], 'eQ': (float(eQ[0][0]), float(eQ[0][1])), 'pj': pj}
+    return {'ei': tuple(np.stack(x, axis=-1) for x in zip(*ei)),
+            'eQ': tuple(np.array(x) for x in zip(*eQ)), 'pj': pj}
+
+
+def main():
+    from score_msm import load_matrices
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out_path', type=str, required=True)
+    parser.add_argument('--matrices_path', type=str, required=True)
+
+    configs = parser.add_mutually_exclusive_group(required=True)
+    configs.add_argument('--config_file', type=str)
+    # e.g. 'p=0.05:0.9:0.05 q=0 r=0.05:0.9:0.05 s=rest', see msm.parameter_grid
+    configs.add_argument('--grid', type=str)
+
+    # number of simulated users per configuration and matrix shape, and
+    # number of them walking at once
+    parser.add_argument('--users', type=int, default=10**6)
+    parser.add_argument('--chunk', type=int, default=10**5)
+    parser.add_argument('--seed', type=int, default=0)
+    # half width of the confidence intervals, in standard errors
+    parser.add_argument('--z', type=float, default=Z95)
+    # intervals from the full covariance of the discounts of a user, whose
+    # memory grows with (N*K)^2, instead of their variances
+    parser.add_argument('--covariance', action='store_true')
+
+    args = parser.parse_args()
+    out_path = args.out_path
+
+    if args.grid is not None:
+        configs = [('MsM_%g_%g_%g_%g' % cfg, cfg) for cfg in msm.parameter_grid(args.grid)]
+    else:
+        with open(args.config_file, 'r') as msm_f:
+            configs = list(ast.literal_eval(msm_f.read()).items())
+
+    blocks = load_matrices(args.matrices_path)
+    for cfg_id, (p, q, r, s) in configs:
+        print(cfg_id)
+        # every configuration is simulated with the same seed
+        simulations = {}
+        with io.open(os.path.join(out_path, cfg_id + '.sim.eval'), 'w', encoding='utf8') as out_f:
+            out_f.write('dataset\tyear\trun\ttopic' +
+                        ''.join('\t%s_%s_sim\t%s_%s_ci' % (cfg_id, v, cfg_id, v)
+                                for v in SIM_VARIANTS) + '\n')
+            for keys, runs in blocks:
+                N, K = runs.shape[1:]
+                if (N, K) not in simulations:
+                    simulations[N, K] = Simulation(N, K, p, q, r, s, args.users, args.seed,
+                                                   args.z, args.chunk,
+                                                   covariance=args.covariance)
+                scores = [simulations[N, K].score(runs, v) for v in SIM_VARIANTS]
+                for m, key in enumerate(keys):
+                    out_f.write('\t'.join(list(key) +
+                                          [str(float(x[m])) for values, ci in scores
+                                           for x in (values, ci)]) + '\n')
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,6 +4,7 @@ import sys
 import os
 import io
 import argparse
+import multiprocessing
 from collections import Counter, defaultdict
 import pickle
 from scorer.reader import *
@@ -11,6 +12,19 @@ from scorer.truth import *
 from scorer.sDCG import *
 from scorer.expected_utility import *
 from scorer.cubetest import *
+from scorer.bounds import *
+from scorer.cache import *
+from scorer.fused import *
+from scorer.manifest import *
+
+# sDCG params
+BQ, B = 4, 2
+
+# EU params
+A, EU_GAMMA, P = 0.001, 0.5, 0.5
+
+# CT params
+CT_GAMMA, MAX_HEIGHT = 0.5, 50
 
 
 def _years(runs_path):
@@ -41,6 +55,137 @@ def str2bool(v):
     else:
         raise argparse.ArgumentTypeError('Boolean value expected.')
     
+# state shared with the worker processes: it is set once per year before the
+# pool is forked, so the truth and the bounds are inherited, not pickled
+_shared = {}
+
+
+def read_run(run_job):
+    """return the name of a run and its (topic_id, SessionView) in topic order"""
+    run, r_name = run_job
+    track, truth, bounds = _shared['track'], _shared['truth'], _shared['bounds']
+    cutoff, list_depth = _shared['cutoff'], _shared['list_depth']
+    sessions = []
+
+    print(run)
+    print(r_name)
+    itercorr = False
+
+    reader = DDReader(run, itercorr)
+    # the docs of the run are looked up in the truth once, by id
+    id_result = reader.id_result(truth.intern(reader.doc_ids))
+
+    # sort by topic no
+    sorted_results = sorted(id_result.items(), key=lambda x: \
+                            int(x[0].split('-')[1]))
+
+    for topic_id, topic_result in sorted_results:
+        if track == 'DD' and bounds.sdcg(topic_id, BQ, B, cutoff, list_depth) == 0:
+            print('Optimal dcg is equal to 0')
+            print(topic_id)
+            print(truth.truth4SDCG(topic_id))
+            print(reader.run_result[topic_id])
+            break
+
+        # sorted and truncated once for every metric
+        sessions.append((topic_id, SessionView(topic_result, cutoff, list_depth)))
+    return r_name, sessions
+
+
+def score_runs(run_jobs):
+    """
+    return the .eval rows of a group of runs, one list per run with a row
+    per topic (and cutoff); the runs of a topic are scored together
+    """
+    track, year = _shared['track'], _shared['year']
+    truth, bounds = _shared['truth'], _shared['bounds']
+    cutoff = _shared['cutoff']
+    # score at every cutoff 1..cutoff, or at cutoff only
+    all_cutoffs = _shared['all_cutoffs']
+    cutoffs = list(range(1, cutoff + 1)) if all_cutoffs else [cutoff]
+    row_format = ('{dataset}\t{year}\t{run}\t{topic}'
+                  + ('\t{cutoff}' if all_cutoffs else '') +
+                  '\t{sDCG}\t{nsDCG}'
+                  '\t{EU}\t{nEU}'
+                  '\t{CT}\t{nCT}'
+                  '\t{sDCGs}\t{nsDCGs}'
+                  '\t{EUs}\t{nEUs}'
+                  '\t{CTs}\t{nCTs}'
+                  '\n')
+
+    bq, b = BQ, B
+    a, eu_gamma, p = A, EU_GAMMA, P
+    ct_gamma, max_height = CT_GAMMA, MAX_HEIGHT
+
+    runs = [read_run(run_job) for run_job in run_jobs]
+    topic_sessions = defaultdict(list)
+    for _, sessions in runs:
+        for topic_id, session in sessions:
+            topic_sessions[topic_id].append(session)
+
+    # with and without subtopics and at every cutoff, in one pass over the
+    # sessions of every topic
+    topic_scores = {}
+    for topic_id, sessions in topic_sessions.items():
+        topic_scores[topic_id] = iter(score_topic_prefixes(
+            truth, bounds, topic_id, sessions, bq, b, a, eu_gamma, p,
+            ct_gamma, max_height, cutoffs, subtopics=(track == 'DD')))
+
+    run_rows = []
+    for r_name, sessions in runs:
+        rows = []
+        for topic_id, _ in sessions:
+            for k, scores in zip(cutoffs, next(topic_scores[topic_id])):
+                # write measurements
+                rows.append(row_format.format(
+                    dataset = track,
+                    year = year,
+                    run = r_name,
+                    topic = topic_id,
+                    cutoff = k,
+                    **scores
+                    ))
+        run_rows.append(rows)
+
+    return run_rows
+
+
+def score_year(year, runs, truth_file_path, dd_info_path):
+    """return {run name: .eval rows} of the runs of a year"""
+    track, cutoff, list_depth = _shared['track'], _shared['cutoff'], _shared['list_depth']
+    all_cutoffs = _shared['all_cutoffs']
+    if track == 'DD':
+        truth = load_truth(truth_file_path, 'DD', dd_info_path,
+                           _shared['max_doc_rel'], _shared['cache_path'])
+        bounds = BoundTable(truth, truth.source)
+
+    bounds_path, workers = _shared['bounds_path'], _shared['workers']
+    if bounds_path:
+        bounds_file = os.path.join(bounds_path, track + '_' + year + '.bounds')
+        bounds.load(bounds_file)
+
+    _shared.update(year=year, truth=truth, bounds=bounds)
+    if workers > 1:
+        # build everything the runs share before forking
+        truth.build_views()
+        for k in range(1, cutoff + 1) if all_cutoffs else [cutoff]:
+            bounds.build(BQ, B, A, EU_GAMMA, P, CT_GAMMA, MAX_HEIGHT,
+                         k, list_depth)
+        # one group of consecutive runs per worker
+        size = -(-len(runs) // workers)
+        groups = [runs[i:i + size] for i in range(0, len(runs), size)]
+        with multiprocessing.get_context('fork').Pool(workers) as pool:
+            # imap keeps the order of the runs
+            run_rows = [rows for group in pool.imap(score_runs, groups)
+                        for rows in group]
+    else:
+        run_rows = score_runs(runs)
+
+    if bounds_path:
+        bounds.save(bounds_file)
+    return {r_name: rows for (_, r_name), rows in zip(runs, run_rows)}
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--runs_path', type=str, required=True)
@@ -53,6 +198,22 @@ def main():
     parser.add_argument('--track', type=str, required=True)
 
     parser.add_argument('--maxrel', type=str2bool, default=True)
+
+    # directory where the normalization bounds are persisted between runs
+    parser.add_argument('--bounds_path', type=str)
+
+    # directory where the parsed truth and params are cached between runs
+    parser.add_argument('--cache_path', type=str)
+
+    # score at every cutoff 1..cutoff, one row per cutoff
+    parser.add_argument('--all_cutoffs', '--all-cutoffs', action='store_true')
+
+    # only score the runs whose inputs changed since the last run (see
+    # scorer/manifest.py) and keep the rows of the others
+    parser.add_argument('--incremental', action='store_true')
+
+    # number of processes scoring runs in parallel
+    parser.add_argument('--workers', type=int, default=1)
     
     args = parser.parse_args()
     runs_path = args.runs_path
@@ -61,12 +222,31 @@ def main():
     list_depth = args.list_depth
     track = args.track
     max_doc_rel = args.maxrel
+    bounds_path = args.bounds_path
+    cache_path = args.cache_path
+    workers = args.workers
+    all_cutoffs = args.all_cutoffs
+    incremental = args.incremental
     print(max_doc_rel)
+    _shared.update(track=track, cutoff=cutoff, list_depth=list_depth,
+                   max_doc_rel=max_doc_rel, all_cutoffs=all_cutoffs,
+                   cache_path=cache_path, bounds_path=bounds_path, workers=workers)
     
-    out_file_path = os.path.join(out_path, track + '.new.max.eval')
+    if all_cutoffs:
+        out_file_path = os.path.join(out_path, track + '.new.max.cutoffs.eval')
+    else:
+        out_file_path = os.path.join(out_path, track + '.new.max.eval')
     
+    # rows of the runs scored last time, merged with the fresh ones
+    if incremental:
+        manifest = Manifest(out_file_path + MANIFEST_SUFFIX)
+        _, old_rows = group_rows(out_file_path, lambda fields: fields[1] + '/' + fields[2])
+    params = (track, cutoff, list_depth, max_doc_rel, all_cutoffs,
+              BQ, B, A, EU_GAMMA, P, CT_GAMMA, MAX_HEIGHT, VERSION)
+
     with io.open(out_file_path, 'w', encoding='utf8') as out_f:
-        out_f.write('dataset\tyear\trun\ttopic\tsDCG\tnsDCG\tEU\tnEU\tCT\tnCT'
+        out_f.write('dataset\tyear\trun\ttopic' + ('\tcutoff' if all_cutoffs else '') +
+        '\tsDCG\tnsDCG\tEU\tnEU\tCT\tnCT'
         '\tsDCGs\tnsDCGs\tEUs\tnEUs\tCTs\tnCTs\n')
     
         for year in _years(runs_path):
@@ -74,136 +254,33 @@ def main():
             if track == 'DD':
                 truth_file_path = _file_path(runs_path, year, 'groundtruth')
                 dd_info_path = _file_path(runs_path, year, 'params')
-                doc_length = pickle.load(open(dd_info_path, 'rb'))
-                truth = DDTruth(truth_file_path, 'DD', doc_length, max_doc_rel)
                 runs = _runs_DD(runs_path, year, 'runs')
-                
+
+            # only the runs whose inputs changed since the last run are scored
+            prints, todo = {}, runs
+            if incremental:
+                source = (file_hash(truth_file_path), file_hash(dd_info_path))
+                prints = {r_name: fingerprint(file_hash(run), source, params)
+                          for run, r_name in runs}
+                todo = [(run, r_name) for run, r_name in runs
+                        if not manifest.unchanged(year + '/' + r_name, prints[r_name],
+                                                  len(old_rows.get(year + '/' + r_name, ())))]
+                print('%d of %d runs changed' % (len(todo), len(runs)))
+
+            new_rows = {}
+            if todo:
+                new_rows = score_year(year, todo, truth_file_path, dd_info_path)
+
             for run, r_name in runs:
-                print(run)
-                print(r_name)
-                itercorr = False
-            
-                run_result = DDReader(run, itercorr).run_result
-            
-                # sort by topic no
-                sorted_results = sorted(run_result.items(), key=lambda x: \
-                                        int(x[0].split('-')[1]))
-                
-                # sDCG params
-                bq, b = 4, 2
-                
-                # EU params
-                a, eu_gamma, p = 0.001, 0.5, 0.5
-        
-                # CT params
-                ct_gamma, max_height = 0.5, 50
-        
-                for topic_id, topic_result in sorted_results:
-                    sdcg, normalized_sdcg, utility, normalized_eu, ct, normalized_ct = 0,0,0,0,0,0
-                    
-                    if track == 'DD':
-                        # sDCG
-                        sdcg = sDCG_per_topic(truth.truth4SDCG(topic_id), \
-                                    topic_result, bq, b, cutoff, list_depth)
-                        sdcg_bound = sDCG_bound_per_topic( \
-                                    truth.truth4SDCG_bound(topic_id), bq, b, \
-                                    cutoff, list_depth)
-                        normalized_sdcg = 0
-                        if sdcg_bound != 0:
-                            normalized_sdcg = sdcg / sdcg_bound
-                        else:
-                            print('Optimal dcg is equal to 0')
-                            print(topic_id)
-                            print(truth.truth4SDCG(topic_id))
-                            print(topic_result)
-                            break
-
-                        
-                        # EU
-                        clear_prob()
-                        utility = eu_per_topic(truth.truth4EU(topic_id), \
-                                topic_result, a, eu_gamma, p, cutoff, list_depth)
-                        upper, lower = eu_bound_per_topic( \
-                                truth.truth4EU_bound(topic_id), a, eu_gamma, p, \
-                                cutoff, list_depth)
-                        normalized_eu = 0
-                        if (upper - lower) != 0:
-                            normalized_eu = (utility - lower) / (upper - lower)
-
-                        # CT
-                        gain, ct, act = cubetest_per_topic( \
-                                            truth.truth4CT(topic_id), \
-                                            topic_result, ct_gamma, max_height, \
-                                            cutoff, list_depth)
-                        bound = ct_bound_per_topic(truth.truth4CT_bound(topic_id),\
-                                    ct_gamma, max_height, cutoff, list_depth)
-                        normalized_ct = 0
-                        if bound != 0:
-                            normalized_ct = ct / bound
-                    
-                    # and again, without subtopics
-                    
-                    # sDCG
-                    sdcg_s = sDCG_per_topic(truth.truth4SDCG_simple(topic_id),\
-                                    topic_result, bq, b, cutoff, list_depth)
-                    sdcg_bound_s = sDCG_bound_per_topic( \
-                                    truth.truth4SDCG_bound_simple(topic_id), \
-                                    bq, b, cutoff, list_depth)
-                    normalized_sdcg_s = 0
-                    if sdcg_bound_s != 0:
-                        normalized_sdcg_s = sdcg_s / sdcg_bound_s
-                    
-                    # EU
-                    clear_prob()
-                    utility_s = eu_per_topic(truth.truth4EU_simple(topic_id), \
-                                    topic_result, a, eu_gamma, p, cutoff, \
-                                    list_depth)
-                    upper_s, lower_s = eu_bound_per_topic( \
-                                        truth.truth4EU_bound_simple(topic_id),\
-                                        a, eu_gamma, p, cutoff, list_depth)
-                    normalized_eu_s = (utility_s - lower_s)/(upper_s - lower_s)
-
-                    # CT
-                    gain_s, ct_s, act_s = cubetest_per_topic( \
-                                            truth.truth4CT_simple(topic_id), \
-                                            topic_result, ct_gamma, \
-                                            max_height, cutoff, list_depth)
-                    bound_s = ct_bound_per_topic( \
-                                truth.truth4CT_bound_simple(topic_id), \
-                                ct_gamma, max_height, cutoff, list_depth)
-                    normalized_ct_s = 0
-                    if bound_s != 0:
-                        normalized_ct_s = ct_s / bound_s
-
-
-                    # write measurements
-                    out_f.write(
-                    '{dataset}\t{year}\t{run}\t{topic}'
-                    '\t{sDCG}\t{nsDCG}'
-                    '\t{EU}\t{nEU}'
-                    '\t{CT}\t{nCT}'
-                    '\t{sDCGs}\t{nsDCGs}'
-                    '\t{EUs}\t{nEUs}'
-                    '\t{CTs}\t{nCTs}'
-                    '\n'.format(
-                        dataset = track,
-                        year = year,
-                        run = r_name,
-                        topic = topic_id,
-                        sDCG = sdcg,
-                        nsDCG = normalized_sdcg,
-                        EU = utility,
-                        nEU = normalized_eu,
-                        CT = ct,
-                        nCT = normalized_ct,
-                        sDCGs = sdcg_s,
-                        nsDCGs = normalized_sdcg_s,
-                        EUs = utility_s,
-                        nEUs = normalized_eu_s,
-                        CTs = ct_s,
-                        nCTs = normalized_ct_s,
-                        ))
+                unit = year + '/' + r_name
+                # a run without rows is recorded like any other
+                rows = new_rows[r_name] if r_name in new_rows else old_rows.get(unit, [])
+                out_f.writelines(rows)
+                if incremental:
+                    manifest.record(unit, prints[r_name], len(rows))
 
+    if incremental:
+        manifest.save()
 
 
 if __name__ == "__main__":
@@ -5,8 +5,12 @@ import os
 import pickle
 import io
 import argparse
+import numpy as np
 from scorer.reader import *
 from scorer.truth import *
+from scorer.matrix_store import *
+from scorer.cache import *
+from scorer.manifest import *
 
 
 def _years(runs_path, track):
@@ -36,6 +40,17 @@ def main():
     
     # DD=dynamic domain track, S=session track
     parser.add_argument('--track', type=str, required=True)
+
+    # store=one memory-mappable tensor per year, pickle=one file per topic-run
+    parser.add_argument('--format', type=str, choices=['store', 'pickle'],
+                        default='store')
+
+    # directory where the parsed truth and params are cached between runs
+    parser.add_argument('--cache_path', type=str)
+
+    # only build the matrices of the runs whose inputs changed since the
+    # last run (see scorer/manifest.py) and keep the others
+    parser.add_argument('--incremental', action='store_true')
     
     args = parser.parse_args()
     runs_path = args.runs_path
@@ -43,44 +58,101 @@ def main():
     cutoff = args.cutoff
     list_depth = args.list_depth
     track = args.track
+    out_format = args.format
+    cache_path = args.cache_path
+    incremental = args.incremental
 
+    params = (track, cutoff, list_depth, out_format)
     for year in _years(runs_path, track):
         if track == 'DD':
             truth_file_path = _file_path(runs_path, year, 'groundtruth')
             dd_info_path = _file_path(runs_path, year, 'params')
-            doc_length = pickle.load(open(dd_info_path, 'rb'))
-            truth = DDTruth(truth_file_path, 'DD', doc_length, 'True')
             runs = _runs_DD(runs_path, year, 'runs')
         if track == 'S':
             runs = _runs_S(runs_path, year)
-            
+
+        # matrices of the runs whose inputs did not change are kept
+        prefix = os.path.join(out_path, store_name(track, year))
+        old_keys, old_matrices, old_rows = [], None, {}
+        fresh = set()
+        if incremental:
+            manifest = Manifest(prefix + MANIFEST_SUFFIX)
+            source = (file_hash(truth_file_path), file_hash(dd_info_path))
+            prints = {r_name: fingerprint(file_hash(run), source, params) for run, r_name in runs}
+            if out_format == 'store' and os.path.exists(prefix + STORE_SUFFIX):
+                old_keys, old_matrices = read_store(prefix + STORE_SUFFIX)
+                for i, key in enumerate(old_keys):
+                    old_rows.setdefault(key[2], []).append(i)
+            # the rows of a run are only counted in a store
+            counted = out_format == 'store'
+            fresh = {r_name for run, r_name in runs
+                     if manifest.unchanged(r_name, prints[r_name],
+                                           len(old_rows.get(r_name, ())) if counted else None)}
+            for r_name in fresh:
+                manifest.record(r_name, prints[r_name],
+                                len(old_rows.get(r_name, ())) if counted else None)
+            print('%s: %d of %d runs changed' % (year, len(runs) - len(fresh), len(runs)))
+            if len(fresh) == len(runs) and set(old_rows) <= fresh and \
+                    os.path.exists(prefix + IDEAL_SUFFIX):
+                manifest.save()
+                continue
+
+        truth = None
+        keys, matrices = [], []
         for run, r_name in runs:
+            if r_name in fresh:
+                if out_format == 'store' and r_name in old_rows:
+                    keys.extend(old_keys[i] for i in old_rows[r_name])
+                    matrices.extend(old_matrices[old_rows[r_name]])
+                continue
+
+            if truth is None:
+                truth = load_truth(truth_file_path, 'DD', dd_info_path, 'True',
+                                   cache_path)
+
             itercorr = False
             
-            run_result = DDReader(run, itercorr).run_result
+            reader = DDReader(run, itercorr)
+            id_result = reader.id_result(truth.intern(reader.doc_ids))
         
             # sort by topic no
-            sorted_results = sorted(run_result.items(), key=lambda x:
+            sorted_results = sorted(id_result.items(), key=lambda x:
                                     int(x[0].split('-')[1]))
 
             for topic_id, topic_result in sorted_results:
-                topic_matrix = [[0 for x in range(cutoff)] for y in range(list_depth)]
-                topic_truth = truth.truth4SDCG(topic_id)
-                sorted_result = sorted(topic_result.items(),key=lambda x: x[0])
-                for query_pos, doc_list in sorted_result: # pos. starts from 0
-                    if query_pos >= cutoff:
-                        break
-                    if(len(doc_list) > list_depth):
-                        doc_list = doc_list[:list_depth]
-                
-                    for doc_pos, doc_no in enumerate(doc_list):
-                        topic_matrix[doc_pos][query_pos] = topic_truth[doc_no]
-
-                f = open(out_path + '/' + \
-                            track + '__' + year + '__'  + \
-                            r_name + '__sum__' + topic_id + '.m','wb')
-                pickle.dump(topic_matrix, f)
-                f.close()
+                gains = truth.gains4SDCG(topic_id)
+                session = SessionView(topic_result, cutoff, list_depth)
+                # pos. starts from 0
+                topic_matrix = np.zeros((list_depth, cutoff), dtype=np.int64)
+                topic_matrix[session.rank, np.array(session.iterations, dtype=np.int64)[session.query]] = \
+                    gains[judged_ids(session.ids, len(gains) - 1)]
+                topic_matrix = topic_matrix.tolist()
+
+                if out_format == 'store':
+                    keys.append((track, year, r_name, topic_id))
+                    matrices.append(topic_matrix)
+                else:
+                    f = open(out_path + '/' + \
+                                track + '__' + year + '__'  + \
+                                r_name + '__sum__' + topic_id + '.m','wb')
+                    pickle.dump(topic_matrix, f)
+                    f.close()
+            if incremental:
+                manifest.record(r_name, prints[r_name],
+                                len(sorted_results) if counted else None)
+
+        if out_format == 'store' and matrices:
+            write_store(out_path, track, year, keys, matrices)
+
+        # ideal gains of every topic, to normalize MsM
+        if truth is None:
+            truth = load_truth(truth_file_path, 'DD', dd_info_path, 'True', cache_path)
+        topic_ids = sorted(truth.topics(), key=lambda x: int(x.split('-')[1]))
+        write_ideal(out_path, track, year, topic_ids,
+                    [ideal_gains(truth.truth4SDCG(topic_id), list_depth * cutoff)
+                     for topic_id in topic_ids])
+        if incremental:
+            manifest.save()
 
 
 if __name__ == "__main__":
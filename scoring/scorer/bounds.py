@@ -0,0 +1,85 @@
+"""
+Bounds used to normalize sDCG, EU and Cube Test
+The ideal values depend only on the topic truth and on the metric parameters,
+so they are computed once and served from a table that can be persisted
+"""
+import os
+import pickle
+from scorer.sDCG import sDCG_bound_per_topic
+from scorer.expected_utility import eu_bound_per_topic
+from scorer.cubetest import ct_bound_per_topic
+
+# bumped whenever a bound routine changes, so older persisted tables are ignored
+VERSION = 2
+
+
+class BoundTable:
+    """
+    table=
+    {
+        (measure, simple, max_doc_rel, topic_id, params..., cutoff, list_depth):
+            bound
+    }
+    """
+
+    def __init__(self, truth, source=None):
+        """
+        :param truth: DDTruth the bounds are computed from
+        :param source: anything identifying the truth files, a persisted table
+            is only reused if it was saved with the same source
+        """
+        self.truth = truth
+        self.source = source
+        self.table = {}
+
+    def _get(self, key, compute):
+        if key not in self.table:
+            self.table[key] = compute()
+        return self.table[key]
+
+    def sdcg(self, topic_id, bq, b, cutoff, list_depth, simple=False):
+        """return the optimal sDCG value"""
+        view = self.truth.truth4SDCG_bound_simple if simple else self.truth.truth4SDCG_bound
+        key = ('sDCG', simple, self.truth.max_doc_rel, topic_id, bq, b, cutoff, list_depth)
+        return self._get(key, lambda: sDCG_bound_per_topic(
+            view(topic_id), bq, b, cutoff, list_depth))
+
+    def eu(self, topic_id, a, gamma, p, cutoff, list_depth, simple=False):
+        """return the upper and lower bounds of EU"""
+        view = self.truth.truth4EU_bound_simple if simple else self.truth.truth4EU_bound
+        key = ('EU', simple, self.truth.max_doc_rel, topic_id, a, gamma, p, cutoff, list_depth)
+        return self._get(key, lambda: eu_bound_per_topic(
+            view(topic_id), a, gamma, p, cutoff, list_depth))
+
+    def ct(self, topic_id, gamma, max_height, cutoff, list_depth, simple=False):
+        """return the optimal CT value"""
+        view = self.truth.truth4CT_bound_simple if simple else self.truth.truth4CT_bound
+        key = ('CT', simple, self.truth.max_doc_rel, topic_id, gamma, max_height, cutoff, list_depth)
+        return self._get(key, lambda: ct_bound_per_topic(
+            view(topic_id), gamma, max_height, cutoff, list_depth))
+
+    def build(self, bq, b, a, eu_gamma, p, ct_gamma, max_height, cutoff,
+              list_depth, topic_ids=None):
+        """compute every bound of the given topics (default all) now"""
+        if topic_ids is None:
+            topic_ids = self.truth.topics()
+        for topic_id in topic_ids:
+            for simple in (False, True):
+                self.sdcg(topic_id, bq, b, cutoff, list_depth, simple)
+                self.eu(topic_id, a, eu_gamma, p, cutoff, list_depth, simple)
+                self.ct(topic_id, ct_gamma, max_height, cutoff, list_depth, simple)
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump({'source': self.source, 'version': VERSION, 'table': self.table}, f)
+
+    def load(self, path):
+        """add the bounds persisted in path, return the number of bounds loaded"""
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+        if data['source'] != self.source or data.get('version') != VERSION:
+            return 0
+        self.table.update(data['table'])
+        return len(data['table'])
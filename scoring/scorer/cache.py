@@ -0,0 +1,91 @@
+"""
+On-disk cache of the parsed ground truth and of the doc length params
+Entries are directories of .npy arrays named after the sha1 of the source
+file, so they load memory-mapped and an edited source file never hits a
+stale entry
+"""
+import os
+import hashlib
+import pickle
+import shutil
+import numpy as np
+from scorer.truth import *
+
+
+def file_hash(path):
+    """return the sha1 hex digest of the content of path"""
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _load_entry(entry_path, names):
+    if not all(os.path.exists(os.path.join(entry_path, name + '.npy')) for name in names):
+        return None
+    return {name: np.load(os.path.join(entry_path, name + '.npy'), mmap_mode='r')
+            for name in names}
+
+
+def _save_entry(entry_path, arrays):
+    # write to a temporary directory first so readers never see half an entry
+    tmp_path = entry_path + '.tmp%d' % os.getpid()
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_path, name + '.npy'), np.asarray(array))
+    try:
+        os.rename(tmp_path, entry_path)
+    except OSError:
+        # another process stored the same entry meanwhile
+        shutil.rmtree(tmp_path)
+
+
+TRUTH_ARRAYS = ('topic_ids', 'subtopic_ids', 'doc_ids', 'passage_ids', 'nugget_ids',
+                'topic_rows', 'topic_subtopics', 'topic_subtopic_num',
+                'topic', 'subtopic', 'doc', 'passage', 'nugget', 'rating')
+DOC_LENGTH_ARRAYS = ('docs', 'lengths')
+
+
+def load_doc_length(params_path, cache_path=None, digest=None):
+    """
+    return the DocLengthTable of a pickled {doc_no: length} params file
+    :param cache_path: cache directory, None to always unpickle
+    :param digest: file_hash(params_path), if already known
+    """
+    if cache_path is None:
+        return DocLengthTable.from_dict(pickle.load(open(params_path, 'rb')))
+
+    entry_path = os.path.join(cache_path, 'doclen-' + (digest or file_hash(params_path)))
+    arrays = _load_entry(entry_path, DOC_LENGTH_ARRAYS)
+    if arrays is not None:
+        return DocLengthTable(arrays['docs'], arrays['lengths'])
+
+    table = DocLengthTable.from_dict(pickle.load(open(params_path, 'rb')))
+    _save_entry(entry_path, {'docs': table.docs, 'lengths': table.lengths})
+    return table
+
+
+def load_truth(truth_path, track, params_path, max_doc_rel=True, cache_path=None):
+    """
+    return the DDTruth of truth_path with the doc lengths of params_path,
+    parsed at most once per content of the two files if cache_path is given
+    truth.source is set to the sha1 of both files
+    """
+    truth_digest = file_hash(truth_path)
+    params_digest = file_hash(params_path)
+    doc_length = load_doc_length(params_path, cache_path, params_digest)
+
+    if cache_path is None:
+        truth = DDTruth(truth_path, track, doc_length, max_doc_rel)
+    else:
+        entry_path = os.path.join(cache_path, 'truth-' + track + '-' + truth_digest)
+        columns = _load_entry(entry_path, TRUTH_ARRAYS)
+        if columns is not None:
+            truth = DDTruth.from_columns(columns, doc_length, max_doc_rel)
+        else:
+            truth = DDTruth(truth_path, track, doc_length, max_doc_rel)
+            _save_entry(entry_path, truth.columns())
+
+    truth.source = (truth_digest, params_digest)
+    return truth
@@ -6,6 +6,7 @@ Copyright 2017 @ Georgetown University
 from scorer.truth import *
 from scorer.reader import *
 from collections import Counter
+import numpy as np
 import statistics
 import argparse
 import sys
@@ -50,7 +51,14 @@ def cubetest(run_file_path, truth_xml_path, doc_len_path, gamma=0.5, max_height=
 
 
 def cubetest_per_topic(topic_truth, topic_result, gamma, max_height, cutoff, list_depth):
-    """return gain, ct and act of one topic"""
+    """
+    return gain, ct and act of one topic
+    :param topic_truth: truth4CT, or gains4CT if the docs of topic_result are ids
+    :param topic_result: iteration# -> doc list, or its SessionView
+    """
+    session = session_view(topic_result, cutoff, list_depth)
+    if isinstance(topic_truth[0], DocRows):
+        return cubetest_per_session([topic_truth], session, gamma, max_height)[0]
     subtopic_num = topic_truth[1]
     topic_truth = topic_truth[0]
     subtopic_height = Counter()  # current height of every subtopic
@@ -73,16 +81,11 @@ def cubetest_per_topic(topic_truth, topic_result, gamma, max_height, cutoff, lis
                 subtopic_count[subtopic_id] += 1
         return gain
 
-    sorted_result = sorted(topic_result.items(), key=lambda x: x[0])
     time = 0.0
     total_gain = 0
     accu_gain = 0
     doc_num = 0
-    for iter_num, doc_list in sorted_result:
-        if iter_num >= cutoff:
-            break
-        if(len(doc_list) > list_depth):
-            doc_list = doc_list[:list_depth]
+    for doc_list in session.doc_lists:
         time += 1
         for doc_no in doc_list:
             total_gain += gain_per_doc(doc_no)
@@ -100,27 +103,179 @@ def cubetest_per_topic(topic_truth, topic_result, gamma, max_height, cutoff, lis
     return total_gain / max_height, ct, act
 
 
+def cubetest_per_session(truths, session, gamma, max_height):
+    """
+    return gain, ct and act of a SessionView of doc ids under each of
+    several gains4CT views, in one pass over the docs
+    """
+    return [values[0] for values in
+            cubetest_per_prefix(truths, session, gamma, max_height, [len(session.iterations)])]
+
+
+def cubetest_per_prefix(truths, session, gamma, max_height, ends):
+    """
+    cubetest_per_session of the first ends[i] iterations of the session, for
+    every i; return [[(gain, ct, act) at every end] of every gains4CT view]
+    """
+    variants = []
+    for rows, n_subtopics, subtopic_num in truths:
+        entries, counts = row_entries(rows, judged_ids(session.ids, len(rows.indptr) - 2))
+        variants.append((rows.columns[entries].tolist(), rows.values[entries].tolist(),
+                         counts.tolist(), 1.0 / subtopic_num,
+                         [0] * n_subtopics,  # current height of every subtopic
+                         [0] * n_subtopics))  # #docs found relevant to every subtopic (nrels)
+    total_gain = [0] * len(truths)
+    accu_gain = [0] * len(truths)
+    entry = [0] * len(truths)
+    # gains after every iteration
+    snapshots = [(list(total_gain), list(accu_gain))]
+
+    first = 0  # first doc of the iteration
+    for time, l in enumerate(session.lens.tolist(), 1):
+        for doc in range(first, first + l):
+            for v, (subtopics, ratings, counts, weight_per_subtopic,
+                    subtopic_height, subtopic_count) in enumerate(variants):
+                gain = 0
+                start, stop = entry[v], entry[v] + counts[doc]
+                for subtopic_id, rating in zip(subtopics[start:stop], ratings[start:stop]):
+                    if subtopic_height[subtopic_id] < max_height:
+                        discount_height = (gamma ** (subtopic_count[subtopic_id] + 1)) * rating
+                        if discount_height + subtopic_height[subtopic_id] > max_height:
+                            discount_height = max_height - subtopic_height[subtopic_id]
+
+                        gain += weight_per_subtopic * discount_height
+                        subtopic_height[subtopic_id] += discount_height
+                        subtopic_count[subtopic_id] += 1
+                entry[v] = stop
+                total_gain[v] += gain
+                accu_gain[v] += (total_gain[v] / max_height / time)
+        first += l
+        snapshots.append((list(total_gain), list(accu_gain)))
+
+    results = [[] for _ in truths]
+    for time, doc_num in zip(ends, session.prefix_docs(ends)):
+        total_gain, accu_gain = snapshots[time]
+        for v in range(len(truths)):
+            if time != 0:
+                ct = total_gain[v] / max_height / time
+            else:
+                ct = 0
+            if doc_num > 0:
+                act = accu_gain[v] / doc_num
+            else:
+                act = 0
+            results[v].append((total_gain[v] / max_height, ct, act))
+    return results
+
+
+def cubetest_per_runs(truths, sessions, gamma, max_height, ends):
+    """
+    cubetest_per_prefix of several sessions of a topic (e.g. one per run) at
+    once, without a loop over the docs; the state of every (gains4CT view,
+    session) pair and subtopic is a cell of a (V * R) x S array
+    :param ends: [number of iterations of every prefix] of every session
+    :return: [[[(gain, ct, act) at every end] of every session] of every view]
+    """
+    R, V = len(sessions), len(truths)
+    D = max([len(session) for session in sessions] + [0])
+    n_states = max(n_subtopics for _, n_subtopics, _ in truths)
+    # row v * R + r holds the state of session r under view v
+    row, doc, subtopic, rating = [], [], [], []
+    weight = np.empty(V * R)
+    times = np.ones((V * R, D), dtype=np.int64)
+    for v, (rows, _, subtopic_num) in enumerate(truths):
+        weight[v * R:(v + 1) * R] = 1.0 / subtopic_num
+        for r, session in enumerate(sessions):
+            entries, counts = row_entries(rows, judged_ids(session.ids, len(rows.indptr) - 2))
+            row.append(np.full(len(entries), v * R + r))
+            doc.append(np.repeat(np.arange(len(session)), counts))
+            subtopic.append(rows.columns[entries])
+            rating.append(rows.values[entries])
+            times[v * R + r, :len(session)] = session.query + 1
+    # entries of every doc of every row, in order
+    row, doc, subtopic, rating = (np.concatenate(c) if c else np.array([], dtype=np.int64)
+                                  for c in (row, doc, subtopic, rating))
+
+    gain = np.zeros(V * R * D)
+    if len(row):
+        # updates of every cell in doc order; the subtopics of a doc are
+        # distinct, so a doc updates a cell at most once
+        cell = row * n_states + subtopic
+        order = np.argsort(cell, kind='stable')
+        _, first, sizes = np.unique(cell[order], return_index=True, return_counts=True)
+        group = np.repeat(np.arange(len(first)), sizes)
+        count = np.arange(len(order)) - np.repeat(first, sizes)  # previous updates of the cell
+
+        # a cell is updated by gamma ** (count + 1) * rating until its height
+        # reaches max_height, the last update being clipped, so the heights
+        # are the running sums of the unclipped updates, summed in order
+        powers = np.array([gamma ** k for k in range(int(count.max()) + 2)])
+        discount_height = powers[count + 1] * rating[order]
+        updates = np.zeros((len(first), int(count.max()) + 1))
+        updates[group, count] = discount_height
+        heights = np.zeros_like(updates)
+        heights[:, 1:] = np.cumsum(updates, axis=1)[:, :-1]
+        height = heights[group, count]
+        discount_height = np.where(height < max_height,
+                                   np.where(discount_height + height > max_height,
+                                            max_height - height, discount_height), 0)
+
+        doc_gain = np.empty(len(order))
+        doc_gain[order] = weight[row[order]] * discount_height
+        # np.add.at sums the gains of a doc in order
+        np.add.at(gain, row * D + doc, doc_gain)
+
+    total_history = np.cumsum(gain.reshape(V * R, D), axis=1)
+    accu_history = np.cumsum(total_history / max_height / times, axis=1)
+
+    total_history, accu_history = total_history.tolist(), accu_history.tolist()
+    results = []
+    for v in range(V):
+        view_results = []
+        for r, session in enumerate(sessions):
+            total, accu = total_history[v * R + r], accu_history[v * R + r]
+            prefixes = []
+            for time, doc_num in zip(ends[r], session.prefix_docs(ends[r])):
+                total_gain = total[doc_num - 1] if doc_num else 0
+                if time != 0:
+                    ct = total_gain / max_height / time
+                else:
+                    ct = 0
+                if doc_num > 0:
+                    act = accu[doc_num - 1] / doc_num
+                else:
+                    act = 0
+                prefixes.append((total_gain / max_height, ct, act))
+            view_results.append(prefixes)
+        results.append(view_results)
+    return results
+
+
 def ct_bound_per_topic(topic_truth, gamma, max_height, cutoff, list_depth):
-    doc_sub_rel, subtopic_num = topic_truth
-    
+    """
+    return the optimal CT value
+    :param topic_truth: truth4CT_bound, subtopic_id: ratings in desc order,
+        number of judged docs, subtopic_num
+    """
+    subtopic_rels, doc_num, subtopic_num = topic_truth
+    # the cutoff * list_depth + 1 best docs of every subtopic are stacked,
+    # the other judged docs count as 0
+    top = cutoff * list_depth + 1
+
     gain = 0
-    subtopic_set = set()
-    for doc_no in doc_sub_rel:
-        for subtopic_id in doc_sub_rel[doc_no]:
-            subtopic_set.add(subtopic_id)
-    for subtopic_id in subtopic_set:
+    # iterated as a set, as the subtopics always were
+    for subtopic_id in set(subtopic_rels):
         subtopic_gain = 0
-        rels = [doc_sub_rel[doc_no][subtopic_id] if subtopic_id in doc_sub_rel[doc_no]
-                else 0
-                for doc_no in doc_sub_rel]
-        rels = sorted(rels, reverse=True)
-        for i, rel in enumerate(rels):
+        ratings = subtopic_rels[subtopic_id]
+        positive = ratings[ratings > 0]
+        zeros = min(doc_num - len(ratings) + int(np.sum(ratings == 0)), top)
+        rels = np.concatenate((positive[:top], np.zeros(zeros, dtype=np.int64),
+                               ratings[ratings < 0]))[:top]
+        for i, rel in enumerate(rels.tolist()):
             h = rel * (gamma ** i)
             if subtopic_gain + h >= max_height:
                 h = max_height - subtopic_gain
             subtopic_gain += h
-            if i >= cutoff * list_depth:
-                break
         gain += subtopic_gain / subtopic_num
 
     opt_ct = gain / max_height #/ max_iter
@@ -3,17 +3,14 @@ Expected Utility
 Copyright 2017 @ Georgetown University
 """
 from scorer.truth import *
+from scorer.truth import _first_seen
 from scorer.reader import *
 from collections import Counter, defaultdict
+import numpy as np
 import statistics
 import sys
 import argparse
 
-PROB = defaultdict(dict)
-
-def clear_prob():
-    PROB.clear()
-
 def eu(run_file_path, truth_xml_path, dd_info_path, cutoff=10, a=0.001, gamma=0.5, p=0.5, verbose=False, max_doc_rel=True):
     """
 
@@ -27,8 +24,6 @@ def eu(run_file_path, truth_xml_path, dd_info_path, cutoff=10, a=0.001, gamma=0.
     :param verbose: if true, print info on stdout
     :return:
     """
-    PROB.clear()
-
     truth = DDTruth(truth_xml_path, dd_info_path, max_doc_rel)
     run_result = DDReader(run_file_path).run_result
 
@@ -63,59 +58,60 @@ def eu(run_file_path, truth_xml_path, dd_info_path, cutoff=10, a=0.001, gamma=0.
 
 
 def eu_per_topic(topic_truth, topic_result, a, gamma, p, cutoff, list_depth):
+    """
+    :param topic_truth: truth4EU, or gains4EU if the docs of topic_result are ids
+    :param topic_result: iteration# -> doc list, or its SessionView
+    """
+    session = session_view(topic_result, cutoff, list_depth)
+    reach = reach_probs(p, list_depth)
+    if isinstance(topic_truth[0], DocRows):
+        return expected_gain_per_session([topic_truth], session, gamma, reach)[0] \
+            - a * expected_cost_per_session(topic_truth[2], session, reach)
     doc_nugget, nugget_rating, doc_length = topic_truth
-    utility = expected_gain_per_topic(topic_result, doc_nugget, nugget_rating, cutoff, gamma, p, list_depth) \
-              - a * expected_cost_per_topic(topic_result, doc_length, cutoff, p, list_depth)
+    reach = reach.tolist()
+    utility = expected_gain_per_topic(session, doc_nugget, nugget_rating, cutoff, gamma, reach, list_depth) \
+              - a * expected_cost_per_topic(session, doc_length, cutoff, reach, list_depth)
     return utility
 
 
+def reach_probs(p, l):
+    """
+    probabilities of reading the doc at position i = 0..l-1 of a list, i.e.
+    of stopping at i + 1 or later; the last position takes the rest of the
+    mass, so this is (1 - p) ** i for every list of at most l docs
+    """
+    return (1 - p) ** np.arange(l)
+
+
 def prob_stop_at_s(p, s, l):
     """probability of stopping at s given the total length l"""
-    if s in PROB:
-        if l in PROB[s]:
-            return PROB[s][l]
-
     if s < l:
-        v = ((1 - p) ** (s - 1)) * p
-    else:
-        k = 0
-        for i in range(1, l):
-            k += ((1 - p) ** (i - 1)) * p
-        v = 1 - k
-
-    PROB[s][l] = v
-    return v
+        return ((1 - p) ** (s - 1)) * p
+    return (1 - p) ** (l - 1)
 
 
-def expected_gain_per_topic(topic_result, doc_nugget, nugget_rating, cutoff, gamma, p, list_depth):
-    """ following Part 4 of the paper"""
+def expected_gain_per_topic(topic_result, doc_nugget, nugget_rating, cutoff, gamma, reach, list_depth):
+    """
+    following Part 4 of the paper
+    :param reach: reach_probs of list_depth
+    """
 
     expected_appear = defaultdict(
         float)  # expected appearance times of different nuggets in the first #cutoff iterations
 
-    sorted_result = sorted(topic_result.items(), key=lambda x: x[0])
+    session = session_view(topic_result, cutoff, list_depth)
 
-    for iter_num, doc_list in sorted_result:  # attention!! iter_num starts from 0
+    for doc_list in session.doc_lists:  # attention!! iterations start from 0
 #        print(doc_list)
-        # iter_num is actually k in the paper, doc_list is l_k
-        if iter_num >= cutoff:
-            break
-        if(len(doc_list) > list_depth):
-            doc_list = doc_list[:list_depth]
-        l = len(doc_list)
-        for s in range(1, l + 1):
-            prob = prob_stop_at_s(p, s, l)
-#            print(prob)
-
-            # count nuggets in the first s docs of current doc_list
-            # (m function in the formula (14) of the paper)
-            m = Counter()
+        # the iteration is actually k in the paper, doc_list is l_k
 
-            for i in range(s):
-                m.update(doc_nugget[doc_list[i]])
-
-            for nugget in m.keys():
-                expected_appear[nugget] += prob * m[nugget]
+        # the count of a nugget in the first s docs (m function in the
+        # formula (14) of the paper) is weighted by the probability of
+        # stopping at s, so a nugget in the doc at position i is counted
+        # with the probability of stopping at i + 1 or later
+        for i, doc_no in enumerate(doc_list):
+            for nugget in doc_nugget.get(doc_no, ()):
+                expected_appear[nugget] += reach[i]
 
     expected_gain = 0
     for nugget, expected_time in expected_appear.items():
@@ -124,15 +120,14 @@ def expected_gain_per_topic(topic_result, doc_nugget, nugget_rating, cutoff, gam
     return expected_gain
 
 
-def expected_cost_per_topic(topic_result, doc_length, cutoff, p, list_depth):
+def expected_cost_per_topic(topic_result, doc_length, cutoff, reach, list_depth):
+    """
+    :param reach: reach_probs of list_depth
+    """
     total_len = 0
 
-    sorted_result = sorted(topic_result.items(), key=lambda x: x[0])
-    for iter_num, doc_list in sorted_result:
-        if iter_num >= cutoff:
-            break
-        if(len(doc_list) > list_depth):
-            doc_list = doc_list[:list_depth]
+    session = session_view(topic_result, cutoff, list_depth)
+    for doc_list in session.doc_lists:
         l = len(doc_list)
 
         cumulated_len = 0
@@ -142,69 +137,140 @@ def expected_cost_per_topic(topic_result, doc_length, cutoff, p, list_depth):
                 # print(doc_list[s - 1])
                 continue
             cumulated_len += doc_length[doc_list[s - 1]]
-            prob = prob_stop_at_s(p, s, l)
+            # probability of stopping at s
+            prob = reach[s - 1] - reach[s] if s < l else reach[s - 1]
             expected_len += (prob * cumulated_len)
 
         total_len += expected_len
 
     return total_len
 
+
+def expected_gain_per_session(truths, session, gamma, reach):
+    """
+    return the expected gain of a SessionView of doc ids under each of
+    several gains4EU views, the nuggets being gathered by id
+    :param reach: reach_probs of session.list_depth
+    """
+    return [values[0] for values in
+            expected_gain_per_prefix(truths, session, gamma, reach, [len(session.iterations)])]
+
+
+def expected_gain_per_prefix(truths, session, gamma, reach, ends):
+    """
+    expected_gain_per_session of the first ends[i] iterations of the session,
+    for ascending ends; return [[gain at every end] of every gains4EU view]
+    """
+    # the nuggets of the doc at position i of a list are counted with the
+    # probability of reading it, in order of the docs
+    reach = reach[session.rank]
+    stops = session.prefix_docs(ends)
+    gains = []
+    for rows, nugget_rating, _ in truths:
+        entries, counts = row_entries(rows, judged_ids(session.ids, len(rows.indptr) - 2))
+        nuggets = rows.columns[entries]
+        weights = np.repeat(reach, counts)
+        entry_stops = np.concatenate(([0], np.cumsum(counts)))[stops].tolist()
+        ratings = nugget_rating.tolist()
+        expected_appear = np.zeros(len(nugget_rating))
+        values = []
+        done = 0
+        for stop in entry_stops:
+            # np.add.at adds in order, so growing the prefix gives the same sums
+            np.add.at(expected_appear, nuggets[done:stop], weights[done:stop])
+            done = stop
+            appear = expected_appear.tolist()
+            expected_gain = 0
+            for nugget in _first_seen(nuggets[:stop])[0].tolist():
+                expected_gain += ratings[nugget] * (1 - gamma ** appear[nugget]) / (1 - gamma)
+            values.append(expected_gain)
+        gains.append(values)
+    return gains
+
+
+def expected_cost_per_session(id_doc_length, session, reach):
+    """
+    expected_cost_per_topic of a SessionView of doc ids, docs without a length are skipped
+    :param reach: reach_probs of session.list_depth
+    """
+    return expected_cost_per_prefix(id_doc_length, session, reach, [len(session.iterations)])[0]
+
+
+def expected_cost_per_prefix(id_doc_length, session, reach, ends):
+    """expected_cost_per_session of the first ends[i] iterations of the session, for every i"""
+    lengths = id_doc_length[session.ids]
+    known = ~np.isnan(lengths)
+    starts = np.repeat(session.prefix_docs(range(len(session.iterations))), session.lens)
+    # length of the docs of a list up to every doc
+    cumulated = np.cumsum(np.where(known, lengths, 0))
+    cumulated -= np.concatenate(([0.0], cumulated))[starts]
+    # probability of stopping at every doc, the last one of a list takes the rest
+    last = session.rank == np.repeat(session.lens, session.lens) - 1
+    stop = reach[session.rank] - np.where(last, 0, reach[np.minimum(session.rank + 1, len(reach) - 1)])
+    # a doc without a length adds no cost, not even the one of the docs before it
+    costs = np.where(known, stop * cumulated, 0)
+    totals = np.concatenate(([0.0], np.cumsum(costs)))[session.prefix_docs(ends)]
+    return totals.tolist()
+
+
+def _rank_counts(l, list_depth):
+    """number of docs at every rank when l docs fill lists of list_depth in turn"""
+    return l // list_depth + (np.arange(list_depth) < l % list_depth)
+
+
+def length_prefix_sums(doc_length):
+    """
+    total length of the i shortest docs, for i = 0..len(doc_length)
+    :param doc_length: sorted (doc, length) pairs, e.g. truth.sorted_doc_len
+    """
+    if hasattr(doc_length, 'prefix_sums'):
+        return doc_length.prefix_sums()
+    return np.concatenate(([0.0], np.cumsum([length for _, length in doc_length],
+                                            dtype=np.float64)))
+
+
+def cost_bounds(prefix, reach, cutoff):
+    """
+    return the min and max cost of cutoff lists of len(reach) docs, the
+    shortest (longest) docs being put at the ranks most likely to be read
+    :param prefix: length_prefix_sums of the sorted doc lengths
+    :param reach: reach_probs of the list depth
+    """
+    list_depth = len(reach)
+    n = len(prefix) - 1
+    counts = _rank_counts(min(n, list_depth * cutoff), list_depth)
+    stops = np.cumsum(counts)
+    starts = stops - counts
+    # docs starts[r]..stops[r] of the ascending (descending) order are at rank r
+    min_cost = float(np.dot(reach, prefix[stops] - prefix[starts]))
+    max_cost = float(np.dot(reach, prefix[n - starts] - prefix[n - stops]))
+    return min_cost, max_cost
+
+
 def eu_bound_per_topic(topic_truth, a, gamma, p, cutoff, list_depth):
     """
     return the upper bound of expected utility score in the first $(cutoff) iterations
-    :param topic_truth: doc_no : rating
+    :param topic_truth: nugget_id: [doc_no, ...], nugget_id: rating, sorted (doc, length)
     :param a: coefficient of cost
     :param gamma: discount base
     :param p: probability of stopping at each document
     :param cutoff: iteration that stops at
     :return: upper bound and lower bounds for EU score in the first $(cutoff) iterations
     """
-    if list_depth == 5:
-        M = 1 + (1 - p) + (1 - p) ** 2 + (1 - p) ** 3 + (1 - p) ** 4 + (1 - p) ** 5
-    else:
-        M = 1 + (1 - p) + (1 - p) ** 2 + (1 - p) ** 3 + (1 - p) ** 4 + (1 - p) ** 5\
-            + (1 - p) ** 6 + (1 - p) ** 7 + (1 - p) ** 8 + (1 - p) ** 9
-    
     nugget_doc, nugget_rating, doc_length = topic_truth
-    upper_bound = 0
-    for nugget_id, nugget_rel in nugget_rating.items():
-        l = min(list_depth * cutoff, len(nugget_doc[nugget_id]))  # max number of docs that can be related to this subtopic
-        s = (l // list_depth) * M  # gain from complete document ranking list
-        base = 1
-        for _ in range(l % list_depth):
-            s += base
-            base *= (1 - p)
-
-        upper_bound += nugget_rel * (1 - gamma ** s)
-    upper_bound = upper_bound / (1 - gamma)
-
-    # doc_len = sorted(doc_length.items(), key=lambda x: x[1])  # sort in ascending order
-    forward_iter = iter(doc_length)
-    backward_iter = reversed(doc_length)
-    min_cost = 0
-    max_cost = 0
-    # print(doc_len)
-    l = min(len(doc_length), list_depth * cutoff)
-    last = l % list_depth  # position of the last document in the last ranking list, start from 0
-    ct = 0
-    for doc_rank in range(list_depth):
-        if doc_rank <= last:
-            k = cutoff
-        else:
-            k = cutoff - 1
-        # print(doc_rank, k)
-        for query_rank in range(k):
-            # print(ct)
-            _, min_doc_cost = next(forward_iter)
-            _, max_doc_cost = next(backward_iter)
-            min_cost += (1 - p) ** doc_rank * min_doc_cost
-            max_cost += (1 - p) ** doc_rank * max_doc_cost
-            ct += 1
-            # print(ct, l)
-            if ct == l:
-                break
-        if ct == l:
-            break
+    reach = reach_probs(p, list_depth)
+    # reach_sums[j]: expected number of docs read among the top j of a list
+    reach_sums = np.concatenate(([0.0], np.cumsum(reach)))
+
+    # the docs of a nugget fill whole lists first, then the top of the last one
+    l = np.minimum(list_depth * cutoff,
+                   np.array([len(nugget_doc[nugget_id]) for nugget_id in nugget_rating],
+                            dtype=np.int64))
+    s = (l // list_depth) * reach_sums[-1] + reach_sums[l % list_depth]
+    rels = np.fromiter(nugget_rating.values(), dtype=np.float64, count=len(nugget_rating))
+    upper_bound = float(np.sum(rels * (1 - gamma ** s))) / (1 - gamma)
+
+    min_cost, max_cost = cost_bounds(length_prefix_sums(doc_length), reach, cutoff)
     upper_bound -= a * min_cost
     lower_bound = - a * max_cost
 
@@ -0,0 +1,90 @@
+"""
+Fused scoring of a session
+sDCG, EU and Cube Test of the subtopic and simple truth views are computed
+together, the session being walked once for all of them
+"""
+from scorer.sDCG import sDCG_per_prefix
+from scorer.expected_utility import expected_gain_per_prefix, expected_cost_per_prefix, reach_probs
+from scorer.cubetest import cubetest_per_runs
+
+
+MEASURES = ('sDCG', 'nsDCG', 'EU', 'nEU', 'CT', 'nCT')
+
+
+def score_session(truth, bounds, topic_id, session, bq, b, a, eu_gamma, p,
+                  ct_gamma, max_height, subtopics=True):
+    """
+    return {measure: value} of the MEASURES and of their simple variants
+    (suffixed with 's', e.g. nsDCGs), the measures of a skipped variant are 0
+    :param truth: DDTruth the session was interned with
+    :param bounds: BoundTable of truth
+    :param session: SessionView of doc ids
+    :param subtopics: also score with subtopics, otherwise only the simple views
+    """
+    return score_session_prefixes(truth, bounds, topic_id, session, bq, b, a, eu_gamma, p,
+                                  ct_gamma, max_height, [session.cutoff], subtopics)[0]
+
+
+def score_session_prefixes(truth, bounds, topic_id, session, bq, b, a, eu_gamma, p,
+                           ct_gamma, max_height, cutoffs, subtopics=True):
+    """
+    score_session at every cutoff of cutoffs (ascending, at most
+    session.cutoff) from one pass over the session; the value at cutoff k
+    is the one a session truncated at k would get
+    :return: [{measure: value} of every cutoff]
+    """
+    return score_topic_prefixes(truth, bounds, topic_id, [session], bq, b, a, eu_gamma, p,
+                                ct_gamma, max_height, cutoffs, subtopics)[0]
+
+
+def score_topic_prefixes(truth, bounds, topic_id, sessions, bq, b, a, eu_gamma, p,
+                         ct_gamma, max_height, cutoffs, subtopics=True):
+    """
+    score_session_prefixes of several sessions of a topic, e.g. one per run;
+    Cube Test scores all the sessions at once
+    :return: [[{measure: value} of every cutoff] of every session]
+    """
+    variants = [False, True] if subtopics else [True]
+    sdcg_truths = [truth.gains4SDCG_simple(topic_id) if simple else truth.gains4SDCG(topic_id)
+                   for simple in variants]
+    eu_truths = [truth.gains4EU_simple(topic_id) if simple else truth.gains4EU(topic_id)
+                 for simple in variants]
+    ct_truths = [truth.gains4CT_simple(topic_id) if simple else truth.gains4CT(topic_id)
+                 for simple in variants]
+    ends = [[session.prefix_iterations(cutoff) for cutoff in cutoffs] for session in sessions]
+    ct = cubetest_per_runs(ct_truths, sessions, ct_gamma, max_height, ends)
+
+    # probability of reading every rank, shared by the sessions
+    reach = reach_probs(p, max([session.list_depth for session in sessions], default=0))
+
+    results = []
+    for r, session in enumerate(sessions):
+        list_depth = session.list_depth
+        sdcg = sDCG_per_prefix(sdcg_truths, session, bq, b, ends[r])
+        gain = expected_gain_per_prefix(eu_truths, session, eu_gamma, reach, ends[r])
+        # the doc lengths do not depend on the variant
+        cost = expected_cost_per_prefix(eu_truths[0][2], session, reach, ends[r])
+
+        prefixes = []
+        for i, cutoff in enumerate(cutoffs):
+            scores = {measure + suffix: 0 for measure in MEASURES for suffix in ('', 's')}
+            for v, simple in enumerate(variants):
+                suffix = 's' if simple else ''
+                sdcg_bound = bounds.sdcg(topic_id, bq, b, cutoff, list_depth, simple)
+                utility = gain[v][i] - a * cost[i]
+                upper, lower = bounds.eu(topic_id, a, eu_gamma, p, cutoff, list_depth, simple)
+                ct_value = ct[v][r][i][1]
+                ct_bound = bounds.ct(topic_id, ct_gamma, max_height, cutoff, list_depth, simple)
+                scores['sDCG' + suffix] = sdcg[v][i]
+                if sdcg_bound != 0:
+                    scores['nsDCG' + suffix] = sdcg[v][i] / sdcg_bound
+                scores['EU' + suffix] = utility
+                # the simple bounds always differ, as in the per metric scoring
+                if simple or (upper - lower) != 0:
+                    scores['nEU' + suffix] = (utility - lower) / (upper - lower)
+                scores['CT' + suffix] = ct_value
+                if ct_bound != 0:
+                    scores['nCT' + suffix] = ct_value / ct_bound
+            prefixes.append(scores)
+        results.append(prefixes)
+    return results
@@ -0,0 +1,87 @@
+"""
+Manifests of incremental evaluation
+A manifest is saved next to an output and records, for every work unit of
+the output (e.g. a run of a year), a fingerprint of everything the unit was
+computed from: the content hash of its input files and its parameters.
+A stage run with --incremental recomputes only the units whose fingerprint
+changed and merges their rows with the rows of the others.
+"""
+import os
+import io
+import json
+import hashlib
+
+MANIFEST_SUFFIX = '.manifest'
+
+
+def fingerprint(*parts):
+    """return the sha1 of the JSON encoding of parts (file hashes, parameters...)"""
+    return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class Manifest:
+    """
+    units=
+    {
+        unit: fingerprint
+    }
+    rows=
+    {
+        unit: number of rows of the unit in the output
+    }
+    The manifest of the previous run is loaded from path; only the units
+    recorded during this run are saved.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.previous, self.previous_rows = {}, {}
+        if os.path.exists(path):
+            with io.open(path, 'r', encoding='utf8') as f:
+                saved = json.load(f)
+            self.previous = saved['units']
+            self.previous_rows = saved.get('rows', {})
+        self.units, self.rows = {}, {}
+
+    def unchanged(self, unit, print_, rows=None):
+        """
+        whether unit was computed from the inputs of fingerprint print_ last time
+        :param rows: number of rows of unit found in the output, None not to
+            check them; a unit whose rows are not all there is changed
+        """
+        if self.previous.get(unit) != print_:
+            return False
+        if rows is None:
+            return True
+        if unit not in self.previous_rows:
+            # manifests without row counts only kept units that had rows
+            return rows > 0
+        return rows == self.previous_rows[unit]
+
+    def record(self, unit, print_, rows=None):
+        self.units[unit] = print_
+        if rows is not None:
+            self.rows[unit] = rows
+
+    def save(self):
+        # write to a temporary file first so readers never see half a manifest
+        with io.open(self.path + '.tmp', 'w', encoding='utf8') as f:
+            json.dump({'units': self.units, 'rows': self.rows}, f, indent=1, sort_keys=True)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def group_rows(path, unit_of):
+    """
+    return the header and the rows of a tab separated output by unit
+    :param unit_of: unit of the fields of a row
+    :return: header line, {unit: [line]}, lines keep their '\n'; None, {}
+        if there is no such output
+    """
+    if not os.path.exists(path):
+        return None, {}
+    rows = {}
+    with io.open(path, 'r', encoding='utf8') as f:
+        header = next(f, None)
+        for line in f:
+            rows.setdefault(unit_of(line.rstrip('\n').split('\t')), []).append(line)
+    return header, rows
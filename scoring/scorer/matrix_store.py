@@ -0,0 +1,107 @@
+"""
+Columnar store of MsM topic matrices
+One memory-mappable (M, list_depth, cutoff) tensor per track and year,
+plus an index of the (track, year, run, topic) of every matrix
+Next to it, the ideal gains of every topic of the year: its judged gains in
+desc order, as many as a matrix has positions, to normalize MsM
+"""
+import os
+import io
+import numpy as np
+
+STORE_SUFFIX = '__sum.npy'
+INDEX_SUFFIX = '__sum.idx'
+IDEAL_SUFFIX = '__max.npy'
+IDEAL_INDEX_SUFFIX = '__max.idx'
+
+
+def store_name(track, year):
+    return track + '__' + year
+
+
+def write_store(out_path, track, year, keys, matrices):
+    """
+    :param keys: [(track, year, run, topic)], one per matrix
+    :param matrices: list_depth x cutoff relevance matrices
+    :return: path of the tensor file
+    """
+    prefix = os.path.join(out_path, store_name(track, year))
+    tensor = np.asarray(matrices, dtype=np.int32)
+    if len(keys) != len(tensor):
+        raise ValueError('one key per matrix is needed')
+
+    # write to temporary files first so readers never see half a store
+    np.save(prefix + '.tmp.npy', tensor)
+    with io.open(prefix + '.tmp.idx', 'w', encoding='utf8') as idx_f:
+        idx_f.write('dataset\tyear\trun\ttopic\n')
+        for key in keys:
+            idx_f.write('\t'.join(key) + '\n')
+    os.replace(prefix + '.tmp.npy', prefix + STORE_SUFFIX)
+    os.replace(prefix + '.tmp.idx', prefix + INDEX_SUFFIX)
+    return prefix + STORE_SUFFIX
+
+
+def read_store(tensor_path):
+    """return keys, (M, list_depth, cutoff) read-only memory-mapped tensor"""
+    prefix = tensor_path[:-len(STORE_SUFFIX)]
+    with io.open(prefix + INDEX_SUFFIX, 'r', encoding='utf8') as idx_f:
+        next(idx_f)
+        keys = [tuple(line.rstrip('\n').split('\t')) for line in idx_f]
+    tensor = np.load(tensor_path, mmap_mode='r')
+    if len(keys) != len(tensor):
+        raise ValueError('%s: index and tensor do not match' % tensor_path)
+    return keys, tensor
+
+
+def list_stores(matrices_path):
+    return sorted(os.path.join(matrices_path, f) for f in os.listdir(matrices_path)
+                  if f.endswith(STORE_SUFFIX) and not f.startswith('.'))
+
+
+def ideal_gains(topic_truth, n):
+    """
+    return the n largest positive ratings of topic_truth (doc_no: rating,
+    e.g. DDTruth.truth4SDCG) in desc order, padded with 0
+    """
+    ratings = np.fromiter(topic_truth.values(), dtype=np.int64, count=len(topic_truth))
+    ratings = ratings[ratings > 0]
+    if len(ratings) > n:
+        # partial sort, only the n largest are ordered
+        ratings = np.partition(ratings, len(ratings) - n)[len(ratings) - n:]
+    gains = np.zeros(n, dtype=np.int64)
+    gains[:len(ratings)] = np.sort(ratings)[::-1]
+    return gains
+
+
+def write_ideal(out_path, track, year, topic_ids, gains):
+    """
+    :param topic_ids: topics of the year
+    :param gains: ideal_gains of every topic, list_depth * cutoff long
+    :return: path of the tensor file
+    """
+    prefix = os.path.join(out_path, store_name(track, year))
+    tensor = np.asarray(gains, dtype=np.int32).reshape(len(topic_ids), -1)
+    np.save(prefix + '.tmp_max.npy', tensor)
+    with io.open(prefix + '.tmp_max.idx', 'w', encoding='utf8') as idx_f:
+        idx_f.write('dataset\tyear\ttopic\n')
+        for topic_id in topic_ids:
+            idx_f.write('\t'.join((track, year, topic_id)) + '\n')
+    os.replace(prefix + '.tmp_max.npy', prefix + IDEAL_SUFFIX)
+    os.replace(prefix + '.tmp_max.idx', prefix + IDEAL_INDEX_SUFFIX)
+    return prefix + IDEAL_SUFFIX
+
+
+def read_ideal(matrices_path):
+    """return {(track, year, topic): ideal gains} of every year in matrices_path"""
+    ideal = {}
+    for path in list_ideals(matrices_path):
+        with io.open(path[:-len(IDEAL_SUFFIX)] + IDEAL_INDEX_SUFFIX, 'r', encoding='utf8') as idx_f:
+            next(idx_f)
+            keys = [tuple(line.rstrip('\n').split('\t')) for line in idx_f]
+        ideal.update(zip(keys, np.load(path)))
+    return ideal
+
+
+def list_ideals(matrices_path):
+    return sorted(os.path.join(matrices_path, f) for f in os.listdir(matrices_path)
+                  if f.endswith(IDEAL_SUFFIX) and not f.startswith('.'))
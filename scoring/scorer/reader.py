@@ -3,6 +3,240 @@ Read, parse run file
 Copyright 2017 @ Georgetown University
 """
 import os
+import bisect
+import numpy as np
+from scorer.truth import _first_seen
+
+
+# bytes str.strip() may remove at the edges of a line, non-ASCII included
+_EDGE = np.zeros(256, dtype=bool)
+_EDGE[[9, 10, 11, 12, 13, 28, 29, 30, 31, 32]] = True
+_EDGE[128:] = True
+
+
+def _field(data, starts, stops):
+    """return data[starts[i]:stops[i]] of every i as a fixed width bytes array"""
+    width = max(int((stops - starts).max()), 1) if len(starts) else 1
+    if len(starts) and int(starts.max()) + width > len(data):
+        data = np.concatenate((data, np.zeros(width, dtype=np.uint8)))
+    # rows of a sliding window view are gathered with one copy each
+    chars = np.lib.stride_tricks.sliding_window_view(data, width)[starts]
+    if len(starts) and int((stops - starts).min()) < width:
+        chars = np.where(np.arange(width) < (stops - starts)[:, None], chars, 0).astype(np.uint8)
+    return chars.view('S%d' % width).reshape(-1)
+
+
+def _integer(data, starts, stops):
+    """
+    return the values of fields of the form [-]digits, at most 18 digits,
+    parsed one column of chars at a time; None if a field has another form
+    """
+    value = np.zeros(len(starts), dtype=np.int64)
+    negative = np.zeros(len(starts), dtype=bool)
+    width = int((stops - starts).max()) if len(starts) else 0
+    if width > 18 or not np.all(stops > starts):
+        return None
+    for j in range(width):
+        at = starts + j
+        inside = at < stops
+        digit = data[np.minimum(at, len(data) - 1)] - np.uint8(48)
+        if j == 0:
+            # '-' is 45
+            negative = inside & (digit == 253)
+        if ((digit > 9) & inside & ~(negative if j == 0 else False)).any():
+            return None
+        value = np.where(inside & (digit <= 9), value * 10 + digit, value)
+    if (negative & (stops - starts == 1)).any():
+        return None
+    return np.where(negative, -value, value)
+
+
+def _split(data):
+    """
+    return the topic, iteration, doc and score columns of a run whose lines
+    all have the same number of fields, nothing to strip and plain integer
+    iterations, None otherwise
+    """
+    if (data == 13).any():
+        # universal newlines are left to text mode
+        return None
+    newlines = np.flatnonzero(data == 10)
+    if len(data) and data[-1] != 10:
+        newlines = np.append(newlines, len(data))
+    starts = np.concatenate(([0], newlines[:-1] + 1))
+    tabs = np.flatnonzero(data == 9)
+    n = len(newlines)
+    k = len(tabs) // n if n else 0
+    if k < 3 or len(tabs) != n * k or not np.all(newlines > starts) or \
+            _EDGE[data[starts]].any() or _EDGE[data[newlines - 1]].any():
+        return None
+    tabs = tabs.reshape(n, k)
+    if not (np.all(tabs[:, 0] > starts) and np.all(tabs[:, -1] < newlines)):
+        return None
+    ends = np.append(tabs, newlines[:, None], axis=1)
+    iteration = _integer(data, tabs[:, 0] + 1, tabs[:, 1])
+    if iteration is None:
+        return None
+    try:
+        score = _field(data, tabs[:, 2] + 1, ends[:, 3]).astype(np.float64)
+    except ValueError:
+        # left to float()
+        return None
+    return (_field(data, starts, tabs[:, 0]), iteration,
+            _field(data, tabs[:, 1] + 1, tabs[:, 2]), score)
+
+
+def _tokenize(text):
+    """
+    return the topic, iteration, doc and score columns of the lines of a run
+    up to the first blank line, with the strip and split rules of the
+    original reader; topics and docs are str arrays
+    """
+    lines = [line.strip() for line in text.split('\n')]
+    # reading stops at the first blank line
+    if '' in lines:
+        lines = lines[:lines.index('')]
+    rows = [line.split('\t') for line in lines]
+    topics, iters, docs, scores = ([row[i] for row in rows] for i in range(4))
+    return (np.array(topics, dtype=str),
+            np.fromiter(map(int, iters), dtype=np.int64, count=len(iters)),
+            np.array(docs, dtype=str),
+            np.fromiter(map(float, scores), dtype=np.float64, count=len(scores)))
+
+
+def _hash(column):
+    """
+    64 bit key of every value of a fixed width bytes column, from its 8 byte
+    words; exact if the values are at most 8 bytes long
+    """
+    width = column.dtype.itemsize
+    words = np.zeros((len(column), -(-width // 8)), dtype=np.uint64)
+    words.view(np.uint8)[:, :width] = column.view(np.uint8).reshape(-1, width)
+    key = words[:, 0].copy()
+    for j in range(1, words.shape[1]):
+        key = key * np.uint64(1000003) ^ words[:, j]
+    return key
+
+
+def _intern(docs, topic):
+    """
+    return the distinct docs, the index of every doc among them and whether
+    the doc was already returned earlier in its topic, the rows being
+    ordered by topic. Fixed width bytes are sorted on _hash, which is
+    cheaper than sorting them, and on the bytes only on a hash collision
+    """
+    keys = [docs]
+    if docs.dtype.kind == 'S' and len(docs):
+        keys.insert(0, _hash(docs))
+    for key in keys:
+        by_doc = np.argsort(key)
+        sorted_key, sorted_docs = key[by_doc], docs[by_doc]
+        new = np.ones(len(docs), dtype=bool)
+        new[1:] = sorted_key[1:] != sorted_key[:-1]
+        if key is docs or np.array_equal(sorted_docs[1:][~new[1:]], sorted_docs[:-1][~new[1:]]):
+            break
+    doc = np.empty(len(docs), dtype=np.int64)
+    doc[by_doc] = np.cumsum(new) - 1
+
+    # the rows of every doc in order, the first row of a (doc, topic) pair
+    # is its first one since the topics are in order
+    by_row = np.argsort(doc * len(doc) + np.arange(len(doc)))
+    sorted_doc, sorted_topic = doc[by_row], topic[by_row]
+    first = np.ones(len(doc), dtype=bool)
+    first[1:] = (sorted_doc[1:] != sorted_doc[:-1]) | (sorted_topic[1:] != sorted_topic[:-1])
+    dup = np.empty(len(doc), dtype=bool)
+    dup[by_row] = ~first
+    return sorted_docs[new], doc, dup
+
+
+def _heads(*columns):
+    """first row of every run of rows with the same values in all the columns"""
+    head = np.zeros(len(columns[0]), dtype=bool)
+    head[:1] = True
+    for column in columns:
+        head[1:] |= column[1:] != column[:-1]
+    return np.flatnonzero(head)
+
+
+def _first_seen_runs(keys, heads):
+    """
+    _first_seen of keys whose runs of equal keys start at heads (see
+    _heads), computed on the first key of every run
+    """
+    uniq, ids = _first_seen(keys[heads])
+    return uniq, np.repeat(ids, np.diff(np.append(heads, len(keys))))
+
+
+class SessionView:
+    """
+    The session of a topic as every metric reads it, built once per
+    (run, topic, cutoff, list_depth):
+    iterations: iteration numbers before cutoff, in order
+    doc_lists: [doc_no1, doc_no2, ...] (or doc ids) of every iteration,
+        truncated to list_depth
+    query: rank (from 0) of the iteration of every doc
+    rank: rank (from 0) of every doc in its list
+    ids: doc ids of the session, if doc_lists holds ids (see DDReader.id_result)
+    """
+
+    def __init__(self, topic_result, cutoff, list_depth):
+        self.cutoff = cutoff
+        self.list_depth = list_depth
+        self.iterations, self.doc_lists = [], []
+        for iter_num, doc_list in sorted(topic_result.items(), key=lambda x: x[0]):
+            if iter_num >= cutoff:
+                break
+            self.iterations.append(iter_num)
+            self.doc_lists.append(doc_list[:list_depth])
+        lens = [len(doc_list) for doc_list in self.doc_lists]
+        self.lens = np.array(lens, dtype=np.int64)
+        self.query = np.repeat(np.arange(len(lens)), lens)
+        self.rank = np.arange(len(self.query)) - np.repeat(np.cumsum(lens) - lens, lens)
+        self._ids = None
+
+    def __len__(self):
+        """number of docs in the session"""
+        return len(self.query)
+
+    @property
+    def ids(self):
+        if self._ids is None:
+            self._ids = np.concatenate(self.doc_lists).astype(np.int64) if self.doc_lists \
+                else np.array([], dtype=np.int64)
+        return self._ids
+
+    def prefix_iterations(self, cutoff):
+        """number of iterations of the session before cutoff"""
+        return bisect.bisect_left(self.iterations, cutoff)
+
+    def prefix_docs(self, ends):
+        """number of docs in the first ends[i] iterations, for every i"""
+        return np.concatenate(([0], np.cumsum(self.lens)))[ends].tolist()
+
+    def matrix(self, fill=-1):
+        """return the doc ids as a len(iterations) x list_depth array, padded with fill"""
+        matrix = np.full((len(self.iterations), self.list_depth), fill, dtype=np.int64)
+        matrix[self.query, self.rank] = self.ids
+        return matrix
+
+
+def session_view(topic_result, cutoff, list_depth):
+    """return the SessionView of topic_result, which can already be one"""
+    if isinstance(topic_result, SessionView):
+        if (topic_result.cutoff, topic_result.list_depth) != (cutoff, list_depth):
+            raise ValueError('the session was built for cutoff=%d, list_depth=%d' %
+                             (topic_result.cutoff, topic_result.list_depth))
+        return topic_result
+    return SessionView(topic_result, cutoff, list_depth)
+
+
+def _decode(vocab):
+    if vocab.dtype.kind == 'S':
+        try:
+            return vocab.astype(str).tolist()
+        except UnicodeDecodeError:
+            return [v.decode('utf-8') for v in vocab.tolist()]
+    return vocab.tolist()
 
 
 class DDReader:
@@ -17,53 +251,114 @@ class DDReader:
             ]
         }
     }
+
+    The run is parsed in bulk into columns sorted by topic (order of
+    appearance), iteration (order of appearance within the topic) and
+    descending score (ties keep the order of the file):
+    topic: index in topic_ids
+    iteration: iteration number
+    doc: index in doc_ids
+    score: score of the doc
+    dup: the doc was already returned earlier in the session of the topic
+    topic_rows[topic_id] = (first row, last row + 1) of the topic, see session()
+    run_result is built from the columns on first use.
     """
 
-    def __init__(self, run_file_path, iter_corr):
-        self.run_result = {}
+    def __init__(self, run_file_path, iter_corr=False):
         assert os.path.exists(run_file_path)
-        f = open(run_file_path)
-        line = f.readline().strip()
-        while line != '':
-            parts = line.split('\t')
-            topic_id, iter_num, doc_no, score = parts[0], int(parts[1]), parts[2], float(parts[3])
-            if iter_corr:
-                iter_num -= 1
-            if topic_id not in self.run_result:
-                self.run_result[topic_id] = {}
-            if iter_num not in self.run_result[topic_id]:
-                self.run_result[topic_id][iter_num] = []
-
-            self.run_result[topic_id][iter_num].append((doc_no, score))
-
-            line = f.readline().strip()
-    
-        f.close()
-
-        # sort within each iteration
-        for topic_id in self.run_result:
-            for iter_num in self.run_result[topic_id]:
-                sorted_run = sorted(self.run_result[topic_id][iter_num], key=lambda x: x[1], reverse=True)
-                # only reserve doc no
-                self.run_result[topic_id][iter_num] = [doc_no for doc_no, score in sorted_run]
-
-        # remove duplicated doc
-        for topic_id in self.run_result:
-            doc_set = set()  # doc that has been found
-            for iter_num in self.run_result[topic_id]:
-                for i in range(len(self.run_result[topic_id][iter_num])):
-                    if self.run_result[topic_id][iter_num][i] in doc_set:
-                        # change the doc no of duplicated doc, so it will become irrelevant
-                        self.run_result[topic_id][iter_num][i] += '_dup'
-                    else:
-                        doc_set.add(self.run_result[topic_id][iter_num][i])
+        with open(run_file_path, 'rb') as f:
+            # fast path: the columns are cut out of the bytes of the file at once
+            columns = _split(np.frombuffer(f.read(), dtype=np.uint8))
+        if columns is None:
+            with open(run_file_path) as f:
+                columns = _tokenize(f.read())
+        topics, iteration, docs, score = columns
+        if iter_corr:
+            iteration -= 1
+
+        topic_ids, topic = _first_seen_runs(topics, _heads(topics))
+        # (topic, iteration) sessions by order of appearance, ranked by topic
+        # first; the rows of a session are usually next to each other
+        heads = _heads(topic, iteration)
+        iter_values = np.unique(iteration[heads])
+        _, session = _first_seen_runs(topic * len(iter_values) + np.searchsorted(iter_values, iteration),
+                                      heads)
+        session_topic = np.zeros(session.max() + 1 if len(session) else 0, dtype=np.int64)
+        session_topic[session] = topic
+        rank = np.empty(len(session_topic), dtype=np.int64)
+        rank[np.argsort(session_topic, kind='stable')] = np.arange(len(session_topic))
+        group = rank[session]
+
+        # stable sort by session and descending score, unless the rows are
+        # already in that order, as most runs are written
+        step = np.diff(group)
+        if not (np.all(step >= 0) and np.all((step > 0) | (np.diff(score) <= 0))):
+            # lexsort is stable, the last key is the primary one
+            order = np.lexsort((-score, group))
+            topic, iteration, docs, score = topic[order], iteration[order], docs[order], score[order]
+        doc_ids, doc, self.dup = _intern(docs, topic)
+
+        self.topic_ids = _decode(topic_ids)
+        self.doc_ids = _decode(doc_ids)
+        self.topic = topic
+        self.iteration = iteration
+        self.doc = doc
+        self.score = score
+
+        bounds = np.searchsorted(self.topic, np.arange(len(self.topic_ids) + 1)).tolist()
+        self.topic_rows = {topic_id: (bounds[t], bounds[t + 1])
+                           for t, topic_id in enumerate(self.topic_ids)}
+        self._run_result = None
+
+    def session(self, topic_id):
+        """return the iteration, doc and dup views of the rows of a topic"""
+        start, stop = self.topic_rows[topic_id]
+        return self.iteration[start:stop], self.doc[start:stop], self.dup[start:stop]
+
+    @property
+    def run_result(self):
+        if self._run_result is None:
+            self._run_result = self._build_run_result()
+        return self._run_result
+
+    def _build_run_result(self):
+        doc_ids = self.doc_ids
+        doc_nos = [doc_ids[d] for d in self.doc.tolist()]
+        # change the doc no of duplicated doc, so it will become irrelevant
+        for i in np.flatnonzero(self.dup).tolist():
+            doc_nos[i] += '_dup'
+        return self._group(doc_nos, ['fill-non-relevant-doc'])
+
+    def id_result(self, doc_ids):
+        """
+        return run_result with the docs replaced by ids
+        :param doc_ids: id of every doc of doc_ids, e.g. truth.intern(reader.doc_ids)
+        :return: topic_id -> {iteration#: int array}, duplicated docs and
+            filled iterations are -1
+        """
+        ids = np.asarray(doc_ids, dtype=np.int64)[self.doc] if len(self.doc) \
+            else np.array([], dtype=np.int64)
+        ids[self.dup] = -1
+        return self._group(ids, np.array([-1]))
+
+    def _group(self, docs, fill):
+        """split the rows of docs into topic_id -> {iteration#: docs}"""
+        result = {}
+        iteration = self.iteration.tolist()
+        # rows where a new (topic, iteration) session starts
+        starts = np.flatnonzero(np.diff(self.topic, prepend=-1) |
+                                np.diff(self.iteration, prepend=self.iteration[:1] - 1)).tolist()
+        for start, stop in zip(starts, starts[1:] + [len(docs)]):
+            topic_id = self.topic_ids[self.topic[start]]
+            result.setdefault(topic_id, {})[iteration[start]] = docs[start:stop]
 
         # fill blank iteration
-        for topic_id in self.run_result:
-            l = max(self.run_result[topic_id].keys()) + 1  # number of iterations for current topic
+        for topic_id in result:
+            l = max(result[topic_id].keys()) + 1  # number of iterations for current topic
             for i in range(l):
-                if i not in self.run_result[topic_id]:
-                    self.run_result[topic_id][i] = ['fill-non-relevant-doc']
+                if i not in result[topic_id]:
+                    result[topic_id][i] = fill.copy()
+        return result
 
     def get_iter_num(self):
         """return iteration number of every topic"""
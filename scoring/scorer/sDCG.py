@@ -5,6 +5,8 @@ Copyright 2017 @ Georgetown University
 from scorer.reader import *
 from scorer.truth import *
 import math
+import functools
+import numpy as np
 import statistics
 import sys
 import argparse
@@ -55,22 +57,72 @@ def sDCG(run_file_path, truth_xml_path, dd_info_path, bq=4, b=2, cutoff=10, verb
 
 
 def sDCG_per_topic(topic_truth, topic_result, bq, b, cutoff, list_depth):
-    """return sDCG of one topic"""
+    """
+    return sDCG of one topic
+    :param topic_truth: doc_no : rating, or gains4SDCG if the docs of
+        topic_result are ids
+    :param topic_result: iteration# -> doc list, or its SessionView
+    """
+    session = session_view(topic_result, cutoff, list_depth)
+    if isinstance(topic_truth, np.ndarray):
+        return sDCG_per_session([topic_truth], session, bq, b)[0]
 
-    sorted_result = sorted(topic_result.items(), key=lambda x: x[0])  # sort by iterations
     sdcg = 0
-    for query_pos, doc_list in sorted_result:  # query position starts from 0
-        if query_pos >= cutoff:
-            break
-        if(len(doc_list) > list_depth):
-            doc_list = doc_list[:list_depth]
-            
+    # query position starts from 0
+    for query_pos, doc_list in zip(session.iterations, session.doc_lists):
         query_discount = 1 + math.log(query_pos + 1, bq)
         for doc_pos, doc_no in enumerate(doc_list):  # doc position also starts from 0
-            sdcg += topic_truth[doc_no] / (1 + math.log(doc_pos + 1, b)) / query_discount
+            sdcg += topic_truth.get(doc_no, 0) / (1 + math.log(doc_pos + 1, b)) / query_discount
     return sdcg
 
 
+@functools.lru_cache(maxsize=None)
+def rank_discounts(base, n):
+    """return 1 + log(rank, base) of the ranks 1..n"""
+    discounts = np.array([1 + math.log(rank, base) for rank in range(1, n + 1)])
+    discounts.flags.writeable = False
+    return discounts
+
+
+def sDCG_per_session(gains_list, session, bq, b):
+    """
+    return the sDCG of a SessionView of doc ids under each of several gain
+    tables (gains4SDCG views), the discounts are computed once
+    """
+    return [values[0] for values in
+            sDCG_per_prefix(gains_list, session, bq, b, [len(session.iterations)])]
+
+
+def sDCG_per_prefix(gains_list, session, bq, b, ends):
+    """
+    sDCG_per_session of the first ends[i] iterations of the session, for
+    every i; return [[sDCG at every end] of every gain table]
+    """
+    stops = session.prefix_docs(ends)
+    if not len(session):
+        return [[0] * len(ends) for _ in gains_list]
+    ids = judged_ids(session.ids, len(gains_list[0]) - 1)
+    rels = np.stack([gains[ids] for gains in gains_list])
+    iterations = np.array(session.iterations)
+    query_discount = rank_discounts(bq, int(iterations.max()) + 1)[iterations[session.query]]
+    terms = rels / rank_discounts(b, int(session.rank.max()) + 1)[session.rank] / query_discount
+    # summed in order, as the doc by doc loop does, so every prefix is exact
+    sums = np.cumsum(terms, axis=1).tolist()
+    return [[row[stop - 1] if stop else 0 for stop in stops] for row in sums]
+
+
+@functools.lru_cache(maxsize=None)
+def discount_table(bq, b, cutoff, list_depth):
+    """return the discounts of all cutoff x list_depth positions, in desc order"""
+    pos_list = []
+    for query_rank in range(cutoff):
+        for doc_rank in range(list_depth):
+            pos_list.append((query_rank + 1, doc_rank + 1))
+
+    dis_list = map(lambda x: 1 / ((1 + math.log(x[1], b)) * (1 + math.log(x[0], bq))), pos_list)
+    return tuple(sorted(dis_list, reverse=True))
+
+
 def sDCG_bound_per_topic(topic_truth, bq, b, cutoff, list_depth):
     """
     return the optimal sDCG value given the iteration cutoff value
@@ -80,20 +132,14 @@ def sDCG_bound_per_topic(topic_truth, bq, b, cutoff, list_depth):
     :param cutoff: iteration that stops at
     :return: optimal sDCG score in the first $(cutoff) iterations
     """
-    pos_list = []
-    for query_rank in range(cutoff):
-        for doc_rank in range(list_depth):
-            pos_list.append((query_rank + 1, doc_rank + 1))
-
-    pos_list = sorted(pos_list, key=lambda x: 1 / ((1 + math.log(x[1], b)) * (1 + math.log(x[0], bq))), reverse=True)
-    dis_list = map(lambda x: 1 / ((1 + math.log(x[1], b)) * (1 + math.log(x[0], bq))), pos_list)
+    dis_list = discount_table(bq, b, cutoff, list_depth)
 
     # sort in desc by relevance scores of each document
     doc_rels = sorted(topic_truth.items(), key=lambda x: x[1], reverse=True)
 
     optimal_score = 0
 
-    for pos, doc_rel, discount in zip(pos_list, doc_rels, dis_list):
+    for doc_rel, discount in zip(doc_rels, dis_list):
         optimal_score += doc_rel[1] * discount
 
     return optimal_score
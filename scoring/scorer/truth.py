@@ -3,41 +3,181 @@ Ground truth
 Copyright 2017 @ Georgetown University
 """
 import xml.etree.ElementTree as ET
-from collections import defaultdict
-import math
+from collections import defaultdict, namedtuple
+from collections.abc import Mapping, Sequence
+from types import MappingProxyType
+import functools
 import pickle
 import io
 import sys
 import numpy as np
 
 
+def _freeze(data):
+    """read-only copy of a truth view, dicts become mapping proxies and lists tuples"""
+    if isinstance(data, dict):
+        return MappingProxyType({k: _freeze(v) for k, v in data.items()})
+    if isinstance(data, list):
+        return tuple(_freeze(v) for v in data)
+    return data
+
+
+def _topic_view(build):
+    """build a truth view once per topic and serve the cached copy afterwards"""
+    @functools.wraps(build)
+    def view(self, topic_id):
+        key = (build.__name__, topic_id)
+        if key not in self._views:
+            self._views[key] = build(self, topic_id)
+        return self._views[key]
+    return view
+
+
+def _intern(values, vocab, index):
+    """return the ids of values, adding the unseen ones to vocab and index"""
+    ids = np.empty(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+        if value not in index:
+            index[value] = len(vocab)
+            vocab.append(value)
+        ids[i] = index[value]
+    return ids
+
+
+def _first_seen(keys):
+    """return the distinct keys in order of first appearance, and the id of
+    the group of every key in that order"""
+    uniq, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return uniq[order], rank[inverse.reshape(-1)]
+
+
+# rows of a sparse per-topic truth view indexed by doc id: the columns (and
+# values) of the doc with id i are columns[indptr[i]:indptr[i + 1]]
+DocRows = namedtuple('DocRows', 'indptr columns values')
+
+
+def judged_ids(ids, n):
+    """map the doc ids that are not among the n judged docs (see
+    DDTruth.intern) to n, the empty row of the gains4* views"""
+    ids = np.asarray(ids, dtype=np.int64)
+    return np.where((ids < 0) | (ids > n), n, ids)
+
+
+def _read_only(*arrays):
+    for array in arrays:
+        if array is not None:
+            array.flags.writeable = False
+
+
+def row_entries(rows, ids):
+    """return the entries of the given rows of a DocRows, in order, and the
+    number of entries of every row"""
+    starts, stops = rows.indptr[ids], rows.indptr[ids + 1]
+    counts = stops - starts
+    offsets = np.repeat(starts - np.cumsum(counts) + counts, counts)
+    return np.arange(counts.sum()) + offsets, counts
+
+
+class DocLengthTable(Mapping):
+    """
+    doc_no -> length, backed by two arrays sorted by length in ascending
+    order (ties keep the order of the params file), which can be memory-mapped
+    """
+
+    def __init__(self, docs, lengths):
+        self.docs = docs
+        self.lengths = lengths
+        # doc_no -> position and the lengths as a list, built together by _lookup
+        self._index = None
+        self._values = None
+        self._prefix_sums = None
+
+    @classmethod
+    def from_dict(cls, doc_length):
+        docs = np.array(list(doc_length.keys()), dtype=str)
+        lengths = np.array(list(doc_length.values()))
+        order = np.argsort(lengths, kind='stable')
+        return cls(docs[order], lengths[order])
+
+    def _lookup(self):
+        if self._index is None:
+            self._index = {doc_no: i for i, doc_no in enumerate(self.docs.tolist())}
+            self._values = self.lengths.tolist()
+        return self._index
+
+    def __getitem__(self, doc_no):
+        index = self._lookup()
+        return self._values[index[doc_no]]
+
+    def __contains__(self, doc_no):
+        return doc_no in self._lookup()
+
+    def __iter__(self):
+        return iter(self._lookup())
+
+    def positions(self, doc_nos):
+        """return the position of every doc_no in docs, -1 if it has no length"""
+        return np.fromiter(map(self._lookup().get, doc_nos, [-1] * len(doc_nos)),
+                           dtype=np.int64, count=len(doc_nos))
+
+    def __len__(self):
+        return len(self.docs)
+
+    def sorted_items(self):
+        """(doc_no, length) pairs in ascending order of length"""
+        return _SortedDocLengths(self)
+
+    def prefix_sums(self):
+        """prefix_sums()[i] is the total length of the i shortest docs"""
+        if self._prefix_sums is None:
+            self._prefix_sums = np.concatenate(([0.0], np.cumsum(self.lengths, dtype=np.float64)))
+            _read_only(self._prefix_sums)
+        return self._prefix_sums
+
+
+class _SortedDocLengths(Sequence):
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        return self.table.docs[i].item(), self.table.lengths[i].item()
+
+    def __len__(self):
+        return len(self.table)
+
+    def prefix_sums(self):
+        return self.table.prefix_sums()
+
+
 class DDTruth:
     """
-    truth=
-    {
-        topic_id:
-        {
-            subtopic_id:
-            {
-                doc_no:
-                {
-                    passage_id:
-                    {
-                        nugget_id:
-                        rating:
-                    }
-                }
-            }
-        }
-    }
+    Passages are kept in flat columns, one entry per passage, ordered by
+    topic, subtopic, doc (order of appearance in the subtopic) and passage:
+
+    topic, subtopic, doc, passage, nugget: interned ids, see topic_ids,
+        subtopic_ids, doc_ids, passage_ids and nugget_ids
+    rating: rating of the passage
+
+    The truth4* views are derived from the rows of a topic with grouped
+    reductions and return the same data as the nested dictionary
+    truth[topic_id][subtopic_id][doc_no][passage_id] = {nugget_id, rating}
+    of the original implementation, which is still available as truth.
     """
 
     def __init__(self, truth_xml_path, track, doc_length=dict(), max_doc_rel=True):
     
-        self.doc_length = doc_length
-        # sort in ascending order
-        self.sorted_doc_len = sorted(self.doc_length.items(), key=lambda x: x[1])
+        self._init_doc_length(doc_length)
         self.max_doc_rel = max_doc_rel
+        # truth views built so far, (view name, topic_id) -> read-only view
+        self._views = {}
+        # identifies the truth and params files, see scorer.cache
+        self.source = None
         print(self.max_doc_rel)
         if track == 'DD':
             self.init_dd(truth_xml_path)
@@ -48,50 +188,75 @@ class DDTruth:
            sys.exit(0)
         
         
-    def init_dd(self, truth_xml_path):
-        
-        self.truth = defaultdict(dict)
-
-        root = ET.parse(truth_xml_path).getroot()
-
-        for domain in list(root):
-            for topic in list(domain):
-                topic_id = topic.attrib['id']
+    @classmethod
+    def from_columns(cls, columns, doc_length=dict(), max_doc_rel=True):
+        """build a DDTruth from the output of columns(), e.g. a cached one"""
+        truth = cls.__new__(cls)
+        truth._init_doc_length(doc_length)
+        truth.max_doc_rel = max_doc_rel
+        truth._views = {}
+        truth.source = None
+        truth._set_columns(columns)
+        return truth
+
+    def _init_doc_length(self, doc_length):
+        if not isinstance(doc_length, DocLengthTable):
+            doc_length = DocLengthTable.from_dict(doc_length)
+        self.doc_length = doc_length
+        # sort in ascending order
+        self.sorted_doc_len = doc_length.sorted_items()
 
-                for subtopic in list(topic):
-                    if subtopic.tag == 'subtopic':
-                        subtopic_id = subtopic.attrib['id']
-                        subtopic_data = defaultdict(dict)
+    def init_dd(self, truth_xml_path):
+        """stream the ground truth xml, root/domain/topic/subtopic/passage"""
+        # topic_id -> {subtopic_id: [(doc_no, passage_id, nugget_id, rating)]}
+        topics = {}
+        path = []
+        for event, elem in ET.iterparse(truth_xml_path, events=('start', 'end')):
+            if event == 'start':
+                path.append(elem)
+                depth = len(path)
+                if depth == 3:
+                    topic_id = elem.attrib['id']
+                elif depth == 4:
+                    in_subtopic = elem.tag == 'subtopic'
+                    if in_subtopic:
+                        subtopic_id = elem.attrib['id']
+                        subtopic_data = {}
                         nugget_id = ''
                         doc_no, rating = '', 0
-                        for passage in list(subtopic):
-                            passage_data = {}
-                            passage_id = passage.attrib['id']
-
-                            for tag_under_passage in list(passage):
-                                if tag_under_passage.tag == 'docno':
-                                    doc_no = tag_under_passage.text
-                                elif tag_under_passage.tag == 'rating':
-                                    rating = int(tag_under_passage.text)
-                                    if rating == 0:
-                                        rating = 1
-                                elif tag_under_passage.tag == 'type':
-                                    if tag_under_passage.text == 'MANUAL':
-                                        nugget_id = passage_id
-
-                            passage_data['nugget_id'] = nugget_id
-                            passage_data['rating'] = rating
-
-                            subtopic_data[doc_no][passage_id] = passage_data
-
-                        self.truth[topic_id][subtopic_id] = subtopic_data
-                        
-    def init_s(self, truth_xml_path):
-        def rec_dd():
-            return defaultdict(rec_dd)
-        
-        self.truth = rec_dd()
+                elif depth == 5 and in_subtopic:
+                    passage_id = elem.attrib['id']
+                continue
+
+            depth = len(path)
+            path.pop()
+            if depth == 6 and in_subtopic:
+                if elem.tag == 'docno':
+                    doc_no = elem.text
+                elif elem.tag == 'rating':
+                    rating = int(elem.text)
+                    if rating == 0:
+                        rating = 1
+                elif elem.tag == 'type':
+                    if elem.text == 'MANUAL':
+                        nugget_id = passage_id
+            elif depth == 5 and in_subtopic:
+                subtopic_data.setdefault(doc_no, {})[passage_id] = (nugget_id, rating)
+            elif depth == 4 and in_subtopic:
+                topics.setdefault(topic_id, {})[subtopic_id] = [
+                    (doc, passage, nugget, r)
+                    for doc, doc_data in subtopic_data.items()
+                    for passage, (nugget, r) in doc_data.items()]
+
+            # the element has been consumed, free it
+            if 1 < depth <= 5:
+                path[-1].remove(elem)
+
+        self._init_columns(topics)
 
+    def init_s(self, truth_xml_path):
+        # topic_id -> {doc_no: rating}
+        qrels = {}
         with io.open(truth_xml_path, mode="r", encoding="utf-8") as f:
         
             for line in f:
@@ -99,30 +264,196 @@ class DDTruth:
                 topic_id = l[0]
                 doc_no = l[1]
                 rating = int(l[2])
-                passage_data = {}
-                passage_data['nugget_id'] = 0
                 if rating == -2:
                     rating = 0
-                passage_data['rating'] = rating
-
-                self.truth[topic_id][0][doc_no][0] = passage_data
-    
+                qrels.setdefault(topic_id, {})[doc_no] = rating
+
+        # a single subtopic, passage and nugget (0) per topic
+        self._init_columns({topic_id: {0: [(doc_no, 0, 0, rating)
+                                           for doc_no, rating in docs.items()]}
+                            for topic_id, docs in qrels.items()})
+
+    def _init_columns(self, topics):
+        """
+        :param topics: topic_id -> {subtopic_id: [(doc_no, passage_id, nugget_id, rating)]}
+        """
+        self.topic_ids, self.subtopic_ids, self.doc_ids = [], [], []
+        self.passage_ids, self.nugget_ids = [], []
+        self.doc_index = {}
+        subtopic_index, passage_index, nugget_index = {}, {}, {}
+
+        # subtopics of every topic, including the ones without passages
+        self.topic_subtopics = {}
+        # topic_id -> (first row, last row + 1)
+        self.topic_rows = {}
+        columns = ([], [], [], [], [], [])
+        n = 0
+        for topic_id, subtopics in topics.items():
+            self.topic_ids.append(topic_id)
+            self.topic_subtopics[topic_id] = tuple(subtopics)
+            start = n
+            for subtopic_id, rows in subtopics.items():
+                for doc_no, passage_id, nugget_id, rating in rows:
+                    for column, value in zip(columns, (topic_id, subtopic_id, doc_no,
+                                                       passage_id, nugget_id, rating)):
+                        column.append(value)
+                n += len(rows)
+            self.topic_rows[topic_id] = (start, n)
+
+        topic, subtopic, doc, passage, nugget, rating = columns
+        self.topic = _intern(topic, list(self.topic_ids),
+                             {t: i for i, t in enumerate(self.topic_ids)})
+        self.subtopic = _intern(subtopic, self.subtopic_ids, subtopic_index)
+        self.doc = _intern(doc, self.doc_ids, self.doc_index)
+        self.passage = _intern(passage, self.passage_ids, passage_index)
+        self.nugget = _intern(nugget, self.nugget_ids, nugget_index)
+        self.rating = np.array(rating, dtype=np.int64)
+        for subtopics in self.topic_subtopics.values():
+            _intern(subtopics, self.subtopic_ids, subtopic_index)
+
+    def columns(self):
+        """return the parsed truth as a dict of arrays, see from_columns"""
+        subtopic_index = {s: i for i, s in enumerate(self.subtopic_ids)}
+        subtopics = [self.topic_subtopics[topic_id] for topic_id in self.topic_ids]
+        return {
+            'topic_ids': np.array(self.topic_ids),
+            'subtopic_ids': np.array(self.subtopic_ids),
+            'doc_ids': np.array(self.doc_ids),
+            'passage_ids': np.array(self.passage_ids),
+            'nugget_ids': np.array(self.nugget_ids),
+            'topic_rows': np.array([self.topic_rows[topic_id] for topic_id in self.topic_ids],
+                                   dtype=np.int64).reshape(-1, 2),
+            'topic_subtopics': np.array([subtopic_index[s] for subs in subtopics for s in subs],
+                                        dtype=np.int64),
+            'topic_subtopic_num': np.array([len(subs) for subs in subtopics], dtype=np.int64),
+            'topic': self.topic,
+            'subtopic': self.subtopic,
+            'doc': self.doc,
+            'passage': self.passage,
+            'nugget': self.nugget,
+            'rating': self.rating,
+        }
 
+    def _set_columns(self, columns):
+        self.topic_ids = columns['topic_ids'].tolist()
+        self.subtopic_ids = columns['subtopic_ids'].tolist()
+        self.doc_ids = columns['doc_ids'].tolist()
+        self.passage_ids = columns['passage_ids'].tolist()
+        self.nugget_ids = columns['nugget_ids'].tolist()
+        self.doc_index = {doc_no: i for i, doc_no in enumerate(self.doc_ids)}
+
+        self.topic_rows = {topic_id: tuple(rows) for topic_id, rows in
+                           zip(self.topic_ids, columns['topic_rows'].tolist())}
+        ends = np.cumsum(columns['topic_subtopic_num']).tolist()
+        subtopics = columns['topic_subtopics'].tolist()
+        self.topic_subtopics = {
+            topic_id: tuple(self.subtopic_ids[s] for s in subtopics[end - n:end])
+            for topic_id, n, end in zip(self.topic_ids, columns['topic_subtopic_num'].tolist(), ends)}
+
+        for name in ('topic', 'subtopic', 'doc', 'passage', 'nugget', 'rating'):
+            setattr(self, name, columns[name])
+
+    def topics(self):
+        """return the topic ids, in order of appearance"""
+        return list(self.topic_ids)
+
+    @property
+    def truth(self):
+        """the nested dictionary layout of the ground truth, see DDTruth"""
+        if not hasattr(self, '_truth'):
+            self._truth = defaultdict(dict)
+            for topic_id in self.topic_ids:
+                for subtopic_id in self.topic_subtopics[topic_id]:
+                    self._truth[topic_id][subtopic_id] = defaultdict(dict)
+                sub, doc, passage, nugget, rating = self._rows(topic_id, self.subtopic,
+                    self.doc, self.passage, self.nugget, self.rating)
+                for s, d, p, g, r in zip(sub, doc, passage, nugget, rating.tolist()):
+                    self._truth[topic_id][self.subtopic_ids[s]][self.doc_ids[d]][
+                        self.passage_ids[p]] = {'nugget_id': self.nugget_ids[g], 'rating': r}
+        return self._truth
+
+    def intern(self, doc_nos):
+        """
+        return the id of every doc_no: the judged docs are numbered as in
+        doc_ids, the other docs of doc_length follow them and unknown docs
+        are -1
+        """
+        judged = np.fromiter(map(self.doc_index.get, doc_nos, [-1] * len(doc_nos)),
+                             dtype=np.int64, count=len(doc_nos))
+        position = self.doc_length.positions(doc_nos)
+        return np.where(judged >= 0, judged,
+                        np.where(position >= 0, len(self.doc_ids) + position, -1))
+
+    @property
+    def id_doc_length(self):
+        """lengths of the docs indexed by id (see intern), nan if unknown"""
+        if not hasattr(self, '_id_doc_length'):
+            table = self.doc_length
+            position = table.positions(self.doc_ids)
+            lengths = np.asarray(table.lengths, dtype=np.float64)
+            judged = np.where(position >= 0, lengths[position] if len(lengths) else np.nan,
+                              np.nan)
+            self._id_doc_length = np.concatenate((judged, lengths, [np.nan]))
+            _read_only(self._id_doc_length)
+        return self._id_doc_length
+
+    def _doc_rows(self, doc_entries):
+        """
+        DocRows of doc_no -> [(column, value)] over the judged docs, with an
+        empty row for the docs that are not judged
+        """
+        n = len(self.doc_ids)
+        ids = [self.doc_index[doc_no] for doc_no in doc_entries]
+        entries = list(doc_entries.values())
+        counts = np.zeros(n + 1, dtype=np.int64)
+        counts[ids] = [len(e) for e in entries]
+        indptr = np.concatenate(([0], np.cumsum(counts)))
+        by_id = sorted(range(len(ids)), key=ids.__getitem__)
+        flat = [entry for i in by_id for entry in entries[i]]
+        columns = np.array([c for c, _ in flat], dtype=np.int64)
+        values = np.array([v for _, v in flat], dtype=np.int64)
+        _read_only(indptr, columns, values)
+        return DocRows(indptr, columns, values)
+
+    def _rows(self, topic_id, *columns):
+        """return the slices of columns holding the passages of topic_id"""
+        start, stop = self.topic_rows.get(topic_id, (0, 0))
+        return tuple(column[start:stop] for column in columns)
+
+    def _reduce(self, group, n, rating):
+        """max (or sum, if not max_doc_rel) of the ratings of each of n groups"""
+        if self.max_doc_rel:
+            values = np.full(n, np.iinfo(np.int64).min)
+            np.maximum.at(values, group, rating)
+        else:
+            values = np.zeros(n, dtype=np.int64)
+            np.add.at(values, group, rating)
+        return values
+
+    def _doc_ratings(self, doc, rating):
+        """
+        reduce the ratings of every doc, in order of first appearance
+        :return: doc ids, max or sum of the ratings of each doc
+        """
+        docs, group = _first_seen(doc)
+        return docs, self._reduce(group, len(docs), rating)
+
+    @_topic_view
     def truth4SDCG(self, topic_id):
         """return doc_no: rating"""
-        return_data = defaultdict(int)
-        for subtopic_id, subtopic_data in self.truth[topic_id].items():
-            for doc_no, doc_data in subtopic_data.items():
-                if self.max_doc_rel:
-                    ratings = []
-                    for _, passage_data in doc_data.items():
-                        ratings.append(passage_data['rating'])
-                        return_data[doc_no] = max(ratings)
-                else:
-                    for _, passage_data in doc_data.items():
-                        return_data[doc_no] += passage_data['rating']
-        return return_data
-    
+        sub, doc, rating = self._rows(topic_id, self.subtopic, self.doc, self.rating)
+        docs, group = _first_seen(doc)
+        if self.max_doc_rel:
+            # the rating of a doc is the max over its passages in the last
+            # subtopic where it appears
+            last = np.zeros(len(docs), dtype=np.int64)
+            np.maximum.at(last, group, np.arange(len(doc)))
+            keep = sub == sub[last][group]
+            values = self._reduce(group[keep], len(docs), rating[keep])
+        else:
+            values = self._reduce(group, len(docs), rating)
+        return _freeze({self.doc_ids[d]: v for d, v in zip(docs, values.tolist())})
+
     
     def truth4SDCG_bound(self, topic_id):
         return self.truth4SDCG(topic_id)
@@ -134,151 +465,211 @@ class DDTruth:
         return self.truth4SDCG(topic_id)
 
 
+    @_topic_view
+    def gains4SDCG(self, topic_id):
+        """return the ratings of truth4SDCG indexed by doc id, with a trailing 0
+        for the docs that are not judged (see judged_ids)"""
+        gains = np.zeros(len(self.doc_ids) + 1, dtype=np.int64)
+        for doc_no, rating in self.truth4SDCG(topic_id).items():
+            gains[self.doc_index[doc_no]] = rating
+        _read_only(gains)
+        return gains
+
+    def gains4SDCG_simple(self, topic_id):
+        return self.gains4SDCG(topic_id)
+
+    @_topic_view
     def truth4CT(self, topic_id):
         """return doc_no: {subtopic_id: rating}, subtopic_num"""
+        sub, doc, rating = self._rows(topic_id, self.subtopic, self.doc, self.rating)
+        docs, doc_group = _first_seen(doc)
+        # (doc, subtopic) pairs, ordered by doc then by subtopic
+        subs, sub_group = _first_seen(sub)
+        pairs, pair_group = _first_seen(doc_group * max(len(subs), 1) + sub_group)
+        _, values = self._doc_ratings(pair_group, rating)
+
+        return_data = {}
+        for pair, value in sorted(zip(pairs.tolist(), values.tolist())):
+            d, s = divmod(pair, max(len(subs), 1))
+            return_data.setdefault(self.doc_ids[docs[d]], {})[self.subtopic_ids[subs[s]]] = value
 
-        return_data = defaultdict(dict)
-        for subtopic_id, subtopic_data in self.truth[topic_id].items():
-            for doc_no, doc_data in subtopic_data.items():
-                ratings = []
-                for _, passage_data in doc_data.items():
-                    ratings.append(passage_data['rating'])
-                if self.max_doc_rel:
-                    r2 = max(ratings)
-                else:
-                    ratings = sorted(ratings, reverse=True)
-                    r1 = 0  # with discount
-                    r2 = 0  # no discount
-                    for i in range(len(ratings)):
-                        r1 += ratings[i] / math.log(i + 2, 2)
-                        r2 += ratings[i]
-                return_data[doc_no][subtopic_id] = r2
-
-        return return_data, len(self.truth[topic_id])
+        return _freeze(return_data), len(self.topic_subtopics.get(topic_id, ()))
 
 
+    @_topic_view
     def truth4CT_simple(self, topic_id):
         """return doc_no: {subtopic_id: rating}, subtopic_num"""
-        return_data = defaultdict(lambda: defaultdict(int))
-        doc_list = defaultdict(list)
-        for subtopic_id, subtopic_data in self.truth[topic_id].items():
-            for doc_no, doc_data in subtopic_data.items():
-                    for _, passage_data in doc_data.items():
-                        doc_list[doc_no].append(passage_data['rating'])
-        for doc_no in doc_list:
-            if self.max_doc_rel:
-                return_data[doc_no]['no subtopics'] = max(doc_list[doc_no])
-            else:
-                return_data[doc_no]['no subtopics'] = sum(doc_list[doc_no])
-        return return_data, 1
-
-
+        doc, rating = self._rows(topic_id, self.doc, self.rating)
+        docs, values = self._doc_ratings(doc, rating)
+        return _freeze({self.doc_ids[d]: {'no subtopics': v}
+                        for d, v in zip(docs, values.tolist())}), 1
+
+
+    def _ct_gains(self, topic_truth):
+        doc_sub_rel, subtopic_num = topic_truth
+        subtopics = {}
+        doc_entries = {doc_no: [(subtopics.setdefault(s, len(subtopics)), r)
+                                for s, r in sub_rel.items()]
+                       for doc_no, sub_rel in doc_sub_rel.items()}
+        return self._doc_rows(doc_entries), len(subtopics), subtopic_num
+
+    @_topic_view
+    def gains4CT(self, topic_id):
+        """
+        return truth4CT as DocRows of (subtopic, rating) indexed by doc id, the
+        subtopics being numbered in order of appearance, the number of such
+        subtopics and subtopic_num
+        """
+        return self._ct_gains(self.truth4CT(topic_id))
+
+    @_topic_view
+    def gains4CT_simple(self, topic_id):
+        return self._ct_gains(self.truth4CT_simple(topic_id))
+
+    def _subtopic_ratings(self, topic_truth):
+        doc_sub_rel, subtopic_num = topic_truth
+        ratings = {}
+        for sub_rel in doc_sub_rel.values():
+            for subtopic_id, rating in sub_rel.items():
+                ratings.setdefault(subtopic_id, []).append(rating)
+        index = {}
+        for subtopic_id, rels in ratings.items():
+            index[subtopic_id] = np.sort(np.array(rels, dtype=np.int64))[::-1]
+            _read_only(index[subtopic_id])
+        return MappingProxyType(index), len(doc_sub_rel), subtopic_num
+
+    @_topic_view
     def truth4CT_bound(self, topic_id):
-        return self.truth4CT(topic_id)
-        
+        """
+        return subtopic_id: ratings of the docs of the subtopic in desc order
+        (subtopics in order of first appearance in truth4CT), the number of
+        judged docs and subtopic_num
+        """
+        return self._subtopic_ratings(self.truth4CT(topic_id))
+
+    @_topic_view
     def truth4CT_bound_simple(self, topic_id):
-        return self.truth4CT_simple(topic_id)
+        return self._subtopic_ratings(self.truth4CT_simple(topic_id))
     
     
+    def _nugget_ratings(self, nugget, rating):
+        """
+        return the nuggets in order of first appearance, the rating of the
+        last passage of each nugget and the number of times the rating of a
+        nugget differs from the one of its previous passage
+        """
+        nuggets, group = _first_seen(nugget)
+        by_nugget = np.argsort(group, kind='stable')
+        last = np.zeros(len(nuggets), dtype=np.int64)
+        np.maximum.at(last, group, np.arange(len(group)))
+
+        g, r = group[by_nugget], rating[by_nugget]
+        conflicts = int(np.sum((g[1:] == g[:-1]) & (r[1:] != r[:-1])))
+        return nuggets, rating[last], conflicts
+
+    @_topic_view
     def truth4EU(self, topic_id):
         """return doc_no:[nugget_id1, nugget_id2,....],  nugget_id: rating, doc: length"""
-        doc_nugget = defaultdict(list)  # doc_no -> nugget list
-        nugget_rating = defaultdict(int)  # nugget_id -> rating
-        for subtopic_id, subtopic_data in self.truth[topic_id].items():
-            for doc_no, doc_data in subtopic_data.items():
-                for passage_id, passage_data in doc_data.items():
-                    doc_nugget[doc_no].append(passage_data['nugget_id'])
-                    if passage_data['nugget_id'] in nugget_rating and nugget_rating[passage_data['nugget_id']] != \
-                            passage_data['rating']:
-                        print('failed!')
-                    nugget_rating[passage_data['nugget_id']] = passage_data['rating']
-        return doc_nugget, nugget_rating, self.doc_length
+        doc, nugget, rating = self._rows(topic_id, self.doc, self.nugget, self.rating)
+
+        # nuggets of every doc, keeping the order of the passages
+        docs, doc_group = _first_seen(doc)
+        by_doc = np.argsort(doc_group, kind='stable')
+        splits = np.cumsum(np.bincount(doc_group, minlength=len(docs)))[:-1]
+        doc_nugget = {self.doc_ids[d]: [self.nugget_ids[g] for g in nuggets]
+                      for d, nuggets in zip(docs, np.split(nugget[by_doc], splits))}
+
+        nuggets, ratings, conflicts = self._nugget_ratings(nugget, rating)
+        for _ in range(conflicts):
+            print('failed!')
+        nugget_rating = {self.nugget_ids[g]: r for g, r in zip(nuggets, ratings.tolist())}
+        return _freeze(doc_nugget), _freeze(nugget_rating), self.doc_length
 
 
     #CHECK why is this different from above
+    @_topic_view
     def truth4EU_bound(self, topic_id):
         """return nugget_id:[doc_no1, doc_no2, ... ], nugget_id: rating, sorted (doc, length)"""
-        nugget_doc = defaultdict(list)  # nugget -> doc_no list
-        nugget_rating = defaultdict(int)  # nugget_id -> rating
-        for subtopic_id, subtopic_data in self.truth[topic_id].items():
-            for doc_no, doc_data in subtopic_data.items():
-                for passage_id, passage_data in doc_data.items():
-                    nugget_id = passage_data["nugget_id"]
-                    if doc_no not in nugget_doc[nugget_id]:
-                        nugget_doc[nugget_id].append(doc_no)
-
-                    nugget_rating[nugget_id] = passage_data['rating']
-
-        return nugget_doc, nugget_rating, self.sorted_doc_len
-
+        doc, nugget, rating = self._rows(topic_id, self.doc, self.nugget, self.rating)
+
+        # distinct docs of every nugget, in order of appearance
+        nuggets, ratings, _ = self._nugget_ratings(nugget, rating)
+        _, nugget_group = _first_seen(nugget)
+        docs, doc_group = _first_seen(doc)
+        pairs, _ = _first_seen(nugget_group * max(len(docs), 1) + doc_group)
+        nugget_doc = {}
+        for pair in pairs.tolist():
+            g, d = divmod(pair, max(len(docs), 1))
+            nugget_doc.setdefault(self.nugget_ids[nuggets[g]], []).append(self.doc_ids[docs[d]])
+
+        nugget_rating = {self.nugget_ids[g]: r for g, r in zip(nuggets, ratings.tolist())}
+        return _freeze(nugget_doc), _freeze(nugget_rating), self.sorted_doc_len
+
+    @_topic_view
     def truth4EU_simple(self, topic_id):
         """return doc_no:[nugget_id1, nugget_id2,....],  nugget_id: rating, doc: length"""
-        doc_nugget = defaultdict(list)  # doc_no -> nugget list
-        nugget_rating = defaultdict(int)  # nugget_id -> rating
-        doc_list = defaultdict(list)
-        for subtopic_id, subtopic_data in self.truth[topic_id].items():
-            for doc_no, doc_data in subtopic_data.items():
-                for passage_id, passage_data in doc_data.items():
-                    if doc_no not in doc_nugget[doc_no]:
-                        doc_nugget[doc_no].append(doc_no)
-                    doc_list[doc_no].append(passage_data['rating'])
-
-        for doc_no in doc_list:
-            if self.max_doc_rel:
-                nugget_rating[doc_no] = max(doc_list[doc_no])
-            else:
-                nugget_rating[doc_no] = sum(doc_list[doc_no])
-        return doc_nugget, nugget_rating, self.doc_length
+        doc, rating = self._rows(topic_id, self.doc, self.rating)
+        docs, values = self._doc_ratings(doc, rating)
+        doc_nugget = {self.doc_ids[d]: [self.doc_ids[d]] for d in docs}
+        nugget_rating = {self.doc_ids[d]: v for d, v in zip(docs, values.tolist())}
+        return _freeze(doc_nugget), _freeze(nugget_rating), self.doc_length
 
+    @_topic_view
     def truth4EU_bound_simple(self, topic_id):
         """return nugget_id:[doc_no1, doc_no2, ... ], nugget_id: rating, sorted (doc, length)"""
-        nugget_doc = defaultdict(list)  # nugget -> doc_no list
-        nugget_rating = defaultdict(int)  # nugget_id -> rating
-        doc_list = defaultdict(list)        
-        for subtopic_id, subtopic_data in self.truth[topic_id].items():
-            for doc_no, doc_data in subtopic_data.items():
-                for passage_id, passage_data in doc_data.items():
-                    nugget_id = doc_no #passage_data["nugget_id"]
-                    if doc_no not in nugget_doc[nugget_id]:
-                        nugget_doc[nugget_id].append(doc_no)
-                    doc_list[doc_no].append(passage_data['rating'])
-        for doc_no in doc_list:
-            if self.max_doc_rel:
-                nugget_rating[doc_no] = max(doc_list[doc_no])
-            else:
-                nugget_rating[doc_no] = sum(doc_list[doc_no])
-
+        nugget_doc, nugget_rating, _ = self.truth4EU_simple(topic_id)
         return nugget_doc, nugget_rating, self.sorted_doc_len
 
+    def _eu_gains(self, topic_truth):
+        doc_nugget, nugget_rating, _ = topic_truth
+        nuggets = {nugget: i for i, nugget in enumerate(nugget_rating)}
+        doc_entries = {doc_no: [(nuggets[nugget], 1) for nugget in doc_nuggets]
+                       for doc_no, doc_nuggets in doc_nugget.items()}
+        rows = self._doc_rows(doc_entries)
+        ratings = np.array(list(nugget_rating.values()), dtype=np.int64)
+        _read_only(ratings)
+        return DocRows(rows.indptr, rows.columns, None), ratings, self.id_doc_length
+
+    @_topic_view
+    def gains4EU(self, topic_id):
+        """
+        return truth4EU indexed by ids: DocRows of the nuggets (numbered as in
+        nugget_rating) of every doc id, the nugget ratings and id_doc_length
+        """
+        return self._eu_gains(self.truth4EU(topic_id))
+
+    @_topic_view
+    def gains4EU_simple(self, topic_id):
+        return self._eu_gains(self.truth4EU_simple(topic_id))
+
+    def build_views(self, topic_ids=None):
+        """build the truth views of every topic now instead of on first use"""
+        if topic_ids is None:
+            topic_ids = self.topics()
+        for topic_id in topic_ids:
+            for view in (self.truth4SDCG, self.truth4CT, self.truth4CT_simple,
+                         self.truth4CT_bound, self.truth4CT_bound_simple,
+                         self.truth4EU, self.truth4EU_bound,
+                         self.truth4EU_simple, self.truth4EU_bound_simple,
+                         self.gains4SDCG, self.gains4CT, self.gains4CT_simple,
+                         self.gains4EU, self.gains4EU_simple):
+                view(topic_id)
+
     def stats(self):
         """print the statistic information about the ground truth"""
-        topic_num = 0
-
-        subtopic_num = 0
-
-        total_doc = set()
-        topic_doc_set = defaultdict(set)
-        doc_num = 0
-        for topic_id in self.truth:
-            topic_num += 1
-            topic_doc = set()
-            
-            for subtopic_id in self.truth[topic_id]:
-                subtopic_num += 1
-                for doc_no in self.truth[topic_id][subtopic_id]:
-                    topic_doc_set[topic_id].add(doc_no)
-                    topic_doc.add(doc_no)
-                    total_doc.add(doc_no)
-            doc_num += len(topic_doc)
-
-        rel_docs = []
-        for topic_id in topic_doc_set:
-            rel_docs.append(len(topic_doc_set[topic_id]))
+        topic_num = len(self.topic_ids)
+        subtopic_num = sum(len(subtopics) for subtopics in self.topic_subtopics.values())
+
+        topic_docs = [len(np.unique(self._rows(topic_id, self.doc)[0]))
+                      for topic_id in self.topic_ids]
+        rel_docs = [n for n in topic_docs if n > 0]
+        doc_num = sum(topic_docs)
+
         print("Topic num:", topic_num)
         print("Subtopic num:", subtopic_num)
         print("Avg subtopic per topic:", subtopic_num / topic_num)
 
-        print("Total Relevant Documents:", len(total_doc))
+        print("Total Relevant Documents:", len(np.unique(self.doc)))
         print("Avg doc per topic:", doc_num / topic_num)
         print("Avg doc per topic:", np.mean(rel_docs))
         print("Std doc per topic:", np.std(rel_docs))
@@ -0,0 +1,22 @@
+import numpy as np
+import pytest
+
+from scorer.truth import DocLengthTable
+
+
+def test_fresh_table_getitem():
+    # nothing has built the index before the first lookup
+    table = DocLengthTable.from_dict({'a': 3, 'b': 1})
+    assert table['a'] == 3
+    assert table.get('b') == 1
+    assert table.get('c') is None
+    with pytest.raises(KeyError):
+        table['c']
+
+
+def test_fresh_memmapped_table_getitem(tmp_path):
+    lengths = np.array([1, 3])
+    np.save(tmp_path / 'lengths.npy', lengths)
+    table = DocLengthTable(np.array(['b', 'a']), np.load(tmp_path / 'lengths.npy', mmap_mode='r'))
+    assert table.get('a') == 3
+    assert table.sorted_items()[0] == ('b', 1)